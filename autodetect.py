@@ -0,0 +1,132 @@
+"""
+Automatic detection of the language of TranslatedItems.
+
+make_translations relies on TranslatedItem.language: an item with the wrong
+language, or with '' ("Unknown"), is either not translated when it should be or
+sent to Google to be "translated" into its own language. These helpers fill in
+the language from the item's translated fields with LangDetect.
+
+Settings:
+DETECT_LANGUAGE_ON_SAVE - detect the language of TranslatedItems when they are saved (default False)
+DETECT_LANGUAGE_OVERWRITE - replace languages that are already set, not just '' (default False)
+DETECT_LANGUAGE_MIN_CONFIDENCE - leave the language alone unless the detected
+    language's share of the score is at least this (default 0.25; see DetectionResult)
+DETECT_LANGUAGE_LANGUAGES - the languages to choose from (default LangDetect's)
+
+Saving many items at once, e.g. in a bulk import, can skip detection:
+with skip_language_detection():
+    for item in items:
+        item.save()
+or for a single item, by setting item.skip_language_detection = True. Languages
+can then be filled in afterwards, in batches, with detect_languages.
+"""
+
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+def get_min_confidence():
+    return getattr(settings, 'DETECT_LANGUAGE_MIN_CONFIDENCE', 0.25)
+
+def get_overwrite():
+    return getattr(settings, 'DETECT_LANGUAGE_OVERWRITE', False)
+
+
+# Stop reading a text on save once the best language leads the second by this much
+EARLY_EXIT_MARGIN = 0.2
+
+DETECTOR = None
+DETECTOR_LOCK = threading.Lock()
+
+def get_detector():
+    """ Returns the LangDetect shared by the whole process, creating it the first time. """
+    global DETECTOR
+    if DETECTOR is None:
+        DETECTOR_LOCK.acquire()
+        try:
+            if DETECTOR is None:
+                from autolex.detection import LangDetect, DEFAULT_LANGUAGES
+                DETECTOR = LangDetect(getattr(settings, 'DETECT_LANGUAGE_LANGUAGES', DEFAULT_LANGUAGES))
+        finally:
+            DETECTOR_LOCK.release()
+    return DETECTOR
+
+
+SKIP = threading.local()
+
+@contextmanager
+def skip_language_detection():
+    """ Turns off detection on save in this thread for the duration of a with block. """
+    old_skip = getattr(SKIP, 'skip', False)
+    SKIP.skip = True
+    try:
+        yield
+    finally:
+        SKIP.skip = old_skip
+
+
+def get_detection_text(object):
+    """ Returns the text of an object's translated fields. """
+    return "\n".join([object.__getattribute__(field) or '' for field in object.translated_fields])
+
+def needs_detection(object, overwrite):
+    return overwrite or not object.language
+
+
+def detect_languages(object_list, overwrite=None, save=False):
+    """
+    Fills in the language of each object in object_list from its translated fields,
+    detecting the languages of all of the objects at once (see LangDetect.detect_many).
+
+    ** Input Parameters **
+    overwrite: replace languages that are already set (default settings.DETECT_LANGUAGE_OVERWRITE)
+    save: save the objects whose language changed, without detecting their language again
+
+    ** Output Parameters **
+    A list of the objects whose language changed.
+    """
+    if overwrite is None:
+        overwrite = get_overwrite()
+    objects = [object for object in object_list if needs_detection(object, overwrite)]
+    if not objects:
+        return []
+
+    changed = []
+    results = get_detector().detect_many([get_detection_text(object) for object in objects])
+    for object, (language, confidence) in zip(objects, results):
+        if confidence >= get_min_confidence() and language != object.language:
+            object.language = language
+            changed.append(object)
+
+    if save:
+        old_skip = getattr(SKIP, 'skip', False)
+        SKIP.skip = True
+        try:
+            for object in changed:
+                object.save()
+        finally:
+            SKIP.skip = old_skip
+    return changed
+
+
+def detect_language_on_save(sender, instance, **kwargs):
+    """
+    pre_save signal handler. Fills in the language of TranslatedItems, if
+    settings.DETECT_LANGUAGE_ON_SAVE is set and detection has not been skipped.
+    """
+    if not getattr(settings, 'DETECT_LANGUAGE_ON_SAVE', False):
+        return
+    from autolex.models import TranslatedItem
+    if not isinstance(instance, TranslatedItem):
+        return
+    if getattr(SKIP, 'skip', False) or getattr(instance, 'skip_language_detection', False):
+        return
+    if not needs_detection(instance, get_overwrite()):
+        return
+
+    # Long texts are only read until the language is clear.
+    result = get_detector().analyze(get_detection_text(instance), margin=EARLY_EXIT_MARGIN)
+    if result.confidence >= get_min_confidence():
+        instance.language = result.language
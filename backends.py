@@ -0,0 +1,153 @@
+"""
+Translation backends.
+
+A backend translates a batch of strings into one language and reports how much
+it accepts in one request. AutoLex talks to the backend named in
+settings.TRANSLATION_BACKEND (a dotted path, GoogleTranslationBackend by default)
+through utils.communicate_with_google_batch.
+
+Use FakeTranslationBackend to test or benchmark AutoLex without the network:
+from autolex.backends import FakeTranslationBackend, set_translation_backend
+set_translation_backend(FakeTranslationBackend(latency=0.2, error_rate=0.05))
+"""
+
+import random
+import threading
+import time
+import urllib
+import urlparse
+import simplejson
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from autolex.connections import HTTPConnectionPool
+
+
+class TranslationBackendError(Exception):
+    pass
+
+
+class TranslationBackend(object):
+    """ Base class for translation backends. """
+
+    # Limits on a single request
+    max_characters = 5000 # url-encoded length of all the strings
+    max_segments = 128 # number of strings
+
+    def translate(self, texts, to_language, ip_address):
+        """
+        Translates a list of utf-8 encoded strings into to_language and returns the
+        translated strings in the same order. Raises an exception if the request fails.
+        ip_address is the address of the user the translation is for.
+        """
+        raise NotImplementedError("translate() not yet implemented.")
+
+
+class GoogleTranslationBackend(TranslationBackend):
+    """
+    Google Translate API v2.
+
+    Requests go through a pool of kept-alive connections (see autolex.connections),
+    configured by these settings:
+    GOOGLE_TRANSLATE_POOL_SIZE - idle connections to keep open (default 4)
+    GOOGLE_TRANSLATE_TIMEOUT - seconds to wait for Google before giving up (default 10)
+    GOOGLE_TRANSLATE_GZIP - ask Google for compressed responses (default True)
+    """
+
+    url = 'https://www.googleapis.com/language/translate/v2'
+
+    def __init__(self, url=None, pool_size=None, timeout=None, gzip=None):
+        self.max_characters = getattr(settings, 'GOOGLE_TRANSLATE_MAX_CHARACTERS', self.max_characters)
+        self.max_segments = getattr(settings, 'GOOGLE_TRANSLATE_MAX_SEGMENTS', self.max_segments)
+        if url is not None:
+            self.url = url
+        if pool_size is None:
+            pool_size = getattr(settings, 'GOOGLE_TRANSLATE_POOL_SIZE', 4)
+        if timeout is None:
+            timeout = getattr(settings, 'GOOGLE_TRANSLATE_TIMEOUT', 10)
+        if gzip is None:
+            gzip = getattr(settings, 'GOOGLE_TRANSLATE_GZIP', True)
+        self.path = urlparse.urlparse(self.url).path
+        self.pool = HTTPConnectionPool(self.url, pool_size, timeout, gzip)
+
+    def translate(self, texts, to_language, ip_address):
+        # Construct the appropriate URL for querying the Google Translate API
+        # The URL includes the texts to translate (one q parameter each), the
+        # desired translation language [to_language], our API key [settings.GOOGLE_API_KEY],
+        # and the user's IP address [ip_address].
+        params = urllib.urlencode([('key', settings.GOOGLE_API_KEY)] + \
+                                      [('q', text) for text in texts] + \
+                                      [('target', to_language), \
+                                       ('userip', ip_address), \
+                                       ('prettyprint', 'true')])
+        # Send the request with a header noting this site as the referer
+        headers = { 'Referer': settings.ROOT_URL , 'X-HTTP-Method-Override': 'GET',
+                    'Content-Type': 'application/x-www-form-urlencoded' }
+
+        # Ask Google for a response and process the JSON string.
+        status, response_headers, body = self.pool.request('POST', self.path, params, headers)
+        results = simplejson.loads(body)
+        translations = results['data']['translations']
+        if len(translations) != len(texts):
+            raise TranslationBackendError("Google returned %s translations for %s strings." \
+                                              % (len(translations), len(texts)))
+        return [t['translatedText'] for t in translations]
+
+
+class FakeTranslationBackend(TranslationBackend):
+    """
+    A deterministic, in-process backend for tests and benchmarks.
+
+    "Translates" each string by prefixing it with the language code, e.g. "[es] Hello".
+    Every request sleeps for `latency` seconds and fails with probability `error_rate`;
+    failures are drawn from a random generator seeded with `seed`, so a run can be repeated.
+    """
+
+    def __init__(self, latency=0, error_rate=0, seed=0, max_characters=5000, max_segments=128):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_characters = max_characters
+        self.max_segments = max_segments
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def translate(self, texts, to_language, ip_address):
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        finally:
+            self.lock.release()
+
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise TranslationBackendError("Fake translation error")
+        return ["[%s] %s" % (to_language, text) for text in texts]
+
+
+TRANSLATION_BACKEND = None
+
+def get_translation_backend():
+    """ Returns the backend named in settings.TRANSLATION_BACKEND, creating it the first time. """
+    global TRANSLATION_BACKEND
+    if TRANSLATION_BACKEND is None:
+        path = getattr(settings, 'TRANSLATION_BACKEND', 'autolex.backends.GoogleTranslationBackend')
+        module_name, class_name = path.rsplit('.', 1)
+        try:
+            backend_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured("Error loading translation backend %s: %s" % (path, e))
+        TRANSLATION_BACKEND = backend_class()
+    return TRANSLATION_BACKEND
+
+def set_translation_backend(backend):
+    """ Replaces the current backend, e.g. with a FakeTranslationBackend. Pass None to reload from settings. """
+    global TRANSLATION_BACKEND
+    TRANSLATION_BACKEND = backend
@@ -0,0 +1,228 @@
+"""
+Backfilling the translations of a whole corpus into a new language.
+
+make_translations only translates the objects a page happens to show. Backfill walks
+every TranslatedItem model instead:
+
+- Objects are read in pages ordered by primary key, each starting after the last key
+  of the previous page (keyset pagination), so memory use stays flat and late pages
+  are as fast to read as early ones.
+- For each page, the fields without an active translation are found with one
+  anti-join (NOT IN) query per field, and sent to Google together through
+  translate_missing_fields.
+- A RateLimiter spends a budget of characters per second, so a backfill does not
+  use up the quota that page views need.
+- After each page, the last key read is written to a JSON checkpoint file. A
+  backfill started again with the same file carries on from there.
+
+Fields that could not be translated are counted and left behind; running the
+backfill again without its checkpoint picks them up. If the circuit breaker opens
+(see autolex.breaker), the backfill stops without checkpointing the page it was on,
+so that page is read again when it resumes.
+
+Use as follows, or through the backfill_translations management command:
+backfill = Backfill('es', '127.0.0.1', checkpoint_path='backfill_es.json')
+backfill.run()
+"""
+
+import os
+import time
+import simplejson
+
+from django.conf import settings
+from django.db.models import get_models
+from django.contrib.contenttypes.models import ContentType
+
+from autolex.models import Translation, TranslatedItem
+from autolex import utils
+
+
+def get_translated_models():
+    """ Returns every installed model that is a TranslatedItem. """
+    return [model for model in get_models() if issubclass(model, TranslatedItem)]
+
+def model_label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name)
+
+
+class RateLimiter(object):
+    """
+    A token bucket: `rate` tokens are added every second, up to `burst`. Spending more
+    tokens than the bucket holds waits until they have been earned.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst is None and self.rate or burst
+        self.tokens = self.burst
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+
+    def spend(self, tokens):
+        """ Waits until `tokens` tokens can be spent, then spends them. """
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= tokens
+        if self.tokens < 0:
+            # Large requests go into debt rather than waiting for a bucket they do not fit in.
+            self.sleep(-self.tokens / self.rate)
+
+
+class Checkpoint(object):
+    """ The progress of a backfill, kept in a JSON file of the form { 'language' : 'es', 'after' : { 'app.Model' : 1000 } } """
+
+    def __init__(self, path, language):
+        self.path = path
+        self.language = language
+        self.after = {}
+        if path and os.path.exists(path):
+            data = simplejson.load(open(path))
+            if data['language'] != language:
+                raise ValueError("The checkpoint in %s is for a backfill into %s, not %s."
+                                 % (path, data['language'], language))
+            self.after = data['after']
+
+    def save(self):
+        if not self.path:
+            return
+        # Replace the file in one step, so that a crash cannot leave half a checkpoint.
+        temporary_path = self.path + '.tmp'
+        f = open(temporary_path, 'w')
+        try:
+            simplejson.dump({'language' : self.language, 'after' : self.after}, f)
+        finally:
+            f.close()
+        os.rename(temporary_path, self.path)
+
+
+class Backfill(object):
+
+    def __init__(self, to_language, ip_address, models=None, batch_size=200, characters_per_second=None,
+                 checkpoint_path=None, report=None):
+        """
+        models: the models to backfill (default: every TranslatedItem model)
+        batch_size: how many objects to read at a time
+        characters_per_second: the rate budget (default settings.BACKFILL_CHARACTERS_PER_SECOND, or no limit)
+        checkpoint_path: the JSON file to record progress in, or None
+        report: called with a dictionary of progress after every page
+        """
+        self.to_language = to_language
+        self.ip_address = ip_address
+        self.models = models or get_translated_models()
+        self.batch_size = batch_size
+        if characters_per_second is None:
+            characters_per_second = getattr(settings, 'BACKFILL_CHARACTERS_PER_SECOND', None)
+        self.limiter = characters_per_second and RateLimiter(characters_per_second) or None
+        self.checkpoint = Checkpoint(checkpoint_path, to_language)
+        self.report = report
+
+        self.objects_read = 0
+        self.fields_translated = 0
+        self.fields_failed = 0
+        self.characters = 0
+
+    def iter_pages(self, model):
+        """ Yields lists of up to batch_size objects, in primary key order, resuming from the checkpoint. """
+        manager = model._default_manager
+        after = self.checkpoint.after.get(model_label(model))
+        while True:
+            page = manager.order_by('pk')
+            if after is not None:
+                page = page.filter(pk__gt=after)
+            page = list(page[:self.batch_size])
+            if not page:
+                return
+            yield page
+            after = page[-1].pk
+
+    def find_missing(self, model, page):
+        """
+        Returns the fields of a page of objects that need a translation, in the form
+        [ (object, ['field1', 'field2']) ] (see find_missing_translations).
+        """
+        objects = model._default_manager.filter(pk__gte=page[0].pk, pk__lte=page[-1].pk) \
+            .exclude(language=self.to_language)
+        if settings.COMMON_IDENTIFIER:
+            translations = Translation.active.filter(language=self.to_language)
+            identifier = settings.COMMON_IDENTIFIER
+        else:
+            translations = Translation.active.filter(language=self.to_language,
+                                                     content_type=ContentType.objects.get_for_model(model))
+            identifier = 'pk'
+
+        missing_fields = {}
+        for field in page[0].translated_fields:
+            # The objects of the page without an active translation of this field
+            ids = objects.exclude(**{identifier + '__in' : translations.filter(field=field).values('object_id')}) \
+                .values_list('pk', flat=True)
+            for id in ids:
+                missing_fields.setdefault(id, []).append(field)
+
+        missing = []
+        for object in page:
+            fields = [field for field in missing_fields.get(object.pk, [])
+                      # do not get a translation if this field is empty
+                      if object.__getattribute__(field)]
+            if fields:
+                missing.append((object, fields))
+        return missing
+
+    def translate(self, missing):
+        characters = sum([len(object.__getattribute__(field)) for object, fields in missing for field in fields])
+        if self.limiter:
+            self.limiter.spend(characters)
+        failed = utils.translate_missing_fields(missing, self.to_language, self.ip_address)
+        self.characters += characters
+        self.fields_translated += sum([len(fields) for object, fields in missing]) - len(failed)
+        self.fields_failed += len(failed)
+
+    def run(self):
+        """
+        Backfills every model, and returns True when done, or False if it stopped early
+        because Google Translate was disabled (see autolex.breaker).
+        """
+        started = time.time()
+        total = sum([model._default_manager.count() for model in self.models])
+        remaining = sum([self.remaining(model) for model in self.models])
+        done_before = total - remaining
+
+        for model in self.models:
+            for page in self.iter_pages(model):
+                if not utils.google_translate_on():
+                    return False
+                missing = self.find_missing(model, page)
+                if missing:
+                    self.translate(missing)
+                    if not utils.google_translate_on():
+                        # The breaker opened during the page, failing the rest of it:
+                        # leave the checkpoint before the page so that it is retried.
+                        return False
+                self.objects_read += len(page)
+                self.checkpoint.after[model_label(model)] = page[-1].pk
+                self.checkpoint.save()
+                if self.report:
+                    self.report(self.progress(started, total, done_before))
+        return True
+
+    def remaining(self, model):
+        after = self.checkpoint.after.get(model_label(model))
+        if after is None:
+            return model._default_manager.count()
+        return model._default_manager.filter(pk__gt=after).count()
+
+    def progress(self, started, total, done_before):
+        """
+        Returns a dictionary of the form { 'objects' : 1200, 'total' : 5000, 'fields' : 2300,
+        'failed' : 4, 'objects_per_second' : 40.0, 'characters_per_second' : 9000.0, 'eta' : 95.0 }
+        """
+        elapsed = max(time.time() - started, 0.001)
+        done = done_before + self.objects_read
+        objects_per_second = self.objects_read / elapsed
+        eta = None
+        if objects_per_second:
+            eta = max(total - done, 0) / objects_per_second
+        return {'objects' : done, 'total' : total, 'fields' : self.fields_translated, 'failed' : self.fields_failed,
+                'objects_per_second' : objects_per_second, 'characters_per_second' : self.characters / elapsed,
+                'eta' : eta}
@@ -0,0 +1,474 @@
+"""
+Benchmarks for AutoLex.
+
+Use as follows, from a Django shell (python manage.py shell):
+from autolex import benchmarks
+benchmarks.run()
+
+Each benchmark returns a dictionary of timings (in seconds) and prints a short
+report. None of them contact Google Translate; benchmark_translation_indexes
+writes to the database (see its docstring).
+"""
+
+import re
+import time
+import random
+import threading
+import urlparse
+import htmllib
+import htmlentitydefs
+from datetime import datetime
+import simplejson
+import BaseHTTPServer
+import SocketServer
+
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Max
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+
+import numpy as np
+
+from autolex import utils
+from autolex.detection import LangDetect, DEFAULT_LANGUAGES
+from autolex.models import Translation
+from autolex.utils import get_missing_fields
+from autolex.pool import map_in_pool
+from autolex.connections import HTTPConnectionPool
+from autolex.backends import FakeTranslationBackend, get_translation_backend, set_translation_backend
+from autolex.breaker import CircuitBreaker
+
+
+class BenchmarkItem(object):
+    """ A stand-in for a TranslatedItem that does not touch the database. """
+    translated_fields = ['title', 'text']
+
+    def __init__(self, id, language='en'):
+        self.id = id
+        self.language = language
+        self.title = "Title of item %s" % id
+        self.text = "Text of item %s" % id
+
+    def __unicode__(self):
+        return self.title
+
+
+class BenchmarkTranslation(object):
+    """ A stand-in for a Translation row. """
+    def __init__(self, content_type_id, object_id, field):
+        self.content_type_id = content_type_id
+        self.object_id = object_id
+        self.field = field
+
+
+def timed(function, *args, **kwargs):
+    """ Calls function and returns (elapsed seconds, result). """
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def report(name, results):
+    print name
+    for key in sorted(results.keys()):
+        print "    %-40s %s" % (key, results[key])
+
+
+def benchmark_missing_fields(n_objects=10000, sample=200, content_type_id=1):
+    """
+    Compares the old filter() scan over existing translations in make_translations
+    with the hash index used by get_missing_fields, for a feed of n_objects objects
+    where every other object already has its title translated.
+
+    The filter() scan is quadratic, so it is only timed on the first `sample` objects
+    of the feed and extrapolated to the whole feed.
+    """
+    objects = [BenchmarkItem(i) for i in range(n_objects)]
+    translations = [BenchmarkTranslation(content_type_id, i, 'title') for i in range(0, n_objects, 2)]
+
+    def filter_scan(object_list):
+        missing = []
+        for object in object_list:
+            fields = []
+            for field in object.translated_fields:
+                translation_for_this_field = filter(lambda x: x.content_type_id == content_type_id and
+                                                    x.object_id == object.id and
+                                                    x.field == field,
+                                                    translations)
+                if translation_for_this_field == []:
+                    fields.append(field)
+            if fields:
+                missing.append((object, fields))
+        return missing
+
+    def hash_index(object_list):
+        existing_translations = set((t.content_type_id, t.object_id, t.field) for t in translations)
+        keyed_objects = [(object, (content_type_id, object.id)) for object in object_list]
+        return get_missing_fields(keyed_objects, existing_translations, 'es')
+
+    scan_time, scan_result = timed(filter_scan, objects[:sample])
+    index_time, index_result = timed(hash_index, objects)
+    assert [(o.id, f) for o, f in scan_result] == [(o.id, f) for o, f in index_result[:len(scan_result)]]
+
+    scan_estimate = scan_time * n_objects / sample
+    results = {
+        'objects': n_objects,
+        'filter scan (extrapolated)': "%.3fs" % scan_estimate,
+        'hash index': "%.3fs" % index_time,
+        'speedup': "%.0fx" % (scan_estimate / max(index_time, 1e-9)),
+    }
+    report("Finding missing translations in make_translations", results)
+    return results
+
+
+def with_backend(backend, function, *args, **kwargs):
+    """
+    Calls function with backend installed and a fresh circuit breaker, then
+    restores the previous backend and breaker.
+    """
+    old_backend = get_translation_backend()
+    old_breaker = utils.GOOGLE_TRANSLATE_BREAKER
+    set_translation_backend(backend)
+    utils.GOOGLE_TRANSLATE_BREAKER = CircuitBreaker()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        set_translation_backend(old_backend)
+        utils.GOOGLE_TRANSLATE_BREAKER = old_breaker
+
+
+def benchmark_translation_throughput(n_objects=200, latency=0.05, max_segments=4, concurrency_levels=(1, 4, 16)):
+    """
+    Measures how long translate_chunks takes to translate every field of a feed of
+    n_objects objects through a FakeTranslationBackend that takes `latency` seconds
+    per request, at several concurrency levels.
+    """
+    objects = [BenchmarkItem(i) for i in range(n_objects)]
+    jobs = [(object, [object.__getattribute__(field)]) for object in objects for field in object.translated_fields]
+
+    results = {'fields': len(jobs)}
+    for concurrency in concurrency_levels:
+        backend = FakeTranslationBackend(latency=latency, max_segments=max_segments)
+        elapsed, translated = timed(with_backend, backend, utils.translate_chunks, jobs, 'es', '127.0.0.1',
+                                    concurrency)
+        assert None not in translated
+        results['concurrency %2s' % concurrency] = "%.2fs, %s requests, %.0f fields/s" % \
+            (elapsed, backend.requests, len(jobs) / elapsed)
+    report("Translating a feed with the fake backend (%.0fms per request)" % (latency * 1000), results)
+    return results
+
+
+def benchmark_error_registry(error_rate=0.5, requests=1000):
+    """
+    Sends single-string requests to a FakeTranslationBackend that fails with
+    probability error_rate and reports how many requests were sent before the
+    circuit breaker opened.
+    """
+    backend = FakeTranslationBackend(error_rate=error_rate)
+    object = BenchmarkItem(0)
+
+    def send_requests():
+        for i in range(requests):
+            if not utils.google_translate_on():
+                break
+            try:
+                utils.communicate_with_google(object, "text", 'es', '127.0.0.1')
+            except Exception:
+                pass
+        return backend.requests
+
+    elapsed, sent = timed(with_backend, backend, send_requests)
+    results = {
+        'error rate': error_rate,
+        'requests before disabling': sent,
+        'errors before disabling': backend.errors,
+    }
+    report("Circuit breaker with the fake backend", results)
+    return results
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers every POST like the Google Translate API, echoing the q parameters back. """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        params = urlparse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])))
+        body = simplejson.dumps({'data': {'translations': [{'translatedText': q} for q in params.get('q', [])]}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def benchmark_connection_pool(requests=500, concurrency=4):
+    """
+    Sends `requests` requests to a local stand-in for the Google Translate API,
+    opening a new connection for every request (as urllib2 does) and then reusing
+    kept-alive connections from an HTTPConnectionPool.
+
+    The stand-in speaks plain HTTP, so the savings shown are the TCP handshakes only;
+    against Google the TLS handshake saved on every request costs much more.
+    """
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    url = 'http://127.0.0.1:%s' % server.server_address[1]
+    body = 'q=Hello+world&target=es'
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    results = {'requests': requests, 'concurrency': concurrency}
+    try:
+        for name, size in (('unpooled', 0), ('pooled', concurrency)):
+            pool = HTTPConnectionPool(url, size=size, gzip=False)
+            elapsed, responses = timed(map_in_pool, lambda i: pool.request('POST', '/', body, headers),
+                                       range(requests), concurrency)
+            pool.close()
+            results[name] = "%.2fs, %.0f requests/s, %s connections" % \
+                (elapsed, requests / elapsed, pool.connections_opened)
+    finally:
+        server.shutdown()
+        server.server_close()
+    report("Connection pooling against a local stand-in server", results)
+    return results
+
+
+def translation_indexes():
+    """
+    Returns a list of (index name, CREATE INDEX statement) pairs for the Translation
+    indexes that sql/translation*.sql define for the current database.
+    """
+    indexes = []
+    for statement in custom_sql_for_model(Translation, no_style(), connection):
+        match = re.search(r'CREATE INDEX (\w+)', statement, re.IGNORECASE)
+        if match:
+            indexes.append((match.group(1), statement))
+    return indexes
+
+
+def drop_index(cursor, name):
+    """ Drops an index if it exists. """
+    if connection.settings_dict['ENGINE'].endswith('mysql'):
+        statement = "DROP INDEX %s ON %s" % (name, Translation._meta.db_table)
+    else:
+        statement = "DROP INDEX %s" % name
+    sid = transaction.savepoint()
+    try:
+        cursor.execute(statement)
+        transaction.savepoint_commit(sid)
+    except DatabaseError:
+        transaction.savepoint_rollback(sid)
+
+
+def benchmark_translation_indexes(n_objects=20000, languages=('es', 'fr', 'de', 'it', 'pt'), lookups=500):
+    """
+    Seeds the Translation table with translations of the title and text of n_objects
+    objects into each of `languages`, then times the lookups made by utils.py without
+    and with the indexes in sql/.
+
+    This writes to the real Translation table, so run it against a development
+    database. The seeded rows are deleted afterwards and the indexes are left in place.
+    """
+    cursor = connection.cursor()
+    table = Translation._meta.db_table
+    content_type = ContentType.objects.get_for_model(Translation)
+    first_id = (Translation.objects.aggregate(Max('object_id'))['object_id__max'] or 0) + 1
+    object_ids = range(first_id, first_id + n_objects)
+    fields = ('title', 'text')
+
+    # Insert the rows directly; saving n_objects * 10 Translations one at a time takes far too long.
+    columns = ('translation', 'language', 'field', 'from_google', 'content_type_id', 'object_id',
+               'is_active', 'created_at', 'last_modified_at')
+    insert = "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join([connection.ops.quote_name(c) for c in columns]),
+                                                 ", ".join(["%s"] * len(columns)))
+    now = datetime.now()
+    rows = [("%s %s %s" % (language, field, object_id), language, field, True, content_type.id, object_id,
+             True, now, now) for object_id in object_ids for language in languages for field in fields]
+    seed_time, ignored = timed(cursor.executemany, insert, rows)
+    transaction.commit_unless_managed()
+
+    sample = random.Random(0).sample(object_ids, lookups)
+    batches = [sample[i:i + 100] for i in range(0, len(sample), 100)]
+
+    def single_lookups():
+        for object_id in sample:
+            Translation.active.filter(object_id=object_id, content_type=content_type,
+                                      field='title', language='es').get()
+
+    def common_identifier_lookups():
+        for object_id in sample:
+            Translation.active.filter(object_id=object_id, field='title', language='es').get()
+
+    def batch_lookups():
+        for batch in batches:
+            list(Translation.active.filter(object_id__in=batch, content_type=content_type, language='es'))
+
+    def time_lookups():
+        times = {}
+        for name, function, count in (('single lookup', single_lookups, len(sample)),
+                                      ('common identifier lookup', common_identifier_lookups, len(sample)),
+                                      ('batch of 100 lookup', batch_lookups, len(batches))):
+            times[name] = timed(function)[0] * 1000 / count
+        return times
+
+    results = {'rows': len(rows), 'seeding': "%.2fs" % seed_time}
+    try:
+        indexes = translation_indexes()
+        for name, statement in indexes:
+            drop_index(cursor, name)
+        transaction.commit_unless_managed()
+        before = time_lookups()
+
+        for name, statement in indexes:
+            cursor.execute(statement)
+        transaction.commit_unless_managed()
+        after = time_lookups()
+
+        for name in before.keys():
+            results[name] = "%.3fms without indexes, %.3fms with indexes" % (before[name], after[name])
+    finally:
+        cursor.execute("DELETE FROM %s WHERE content_type_id = %%s AND object_id >= %%s" % table,
+                       [content_type.id, first_id])
+        transaction.commit_unless_managed()
+    report("Translation lookups in a table of %s rows" % len(rows), results)
+    return results
+
+
+def synthetic_texts(detector, languages, texts_per_language, words_per_text, seed):
+    """
+    Returns a list of (language, text) pairs. Each text is made of three-letter
+    "words", each a trigram drawn from the language's trigram frequencies.
+    """
+    random_state = np.random.RandomState(seed)
+    postings = detector.postings
+    rows = np.repeat(np.arange(len(detector.trigrams)), np.diff(postings.indptr))
+    texts = []
+    for language in languages:
+        column = detector.model_languages.index(language)
+        entries = np.nonzero(np.asarray(postings.languages) == column)[0]
+        probabilities = np.asarray(postings.weights)[entries]
+        probabilities = probabilities / probabilities.sum()
+        for i in range(texts_per_language):
+            chosen = random_state.choice(rows[entries], size=words_per_text, p=probabilities)
+            # Django model fields are unicode
+            texts.append((language, ' '.join([detector.trigrams[row] for row in chosen]).decode('utf-8')))
+    return texts
+
+
+def benchmark_language_detection(texts_per_language=20, words_per_text=20, seed=0):
+    """
+    Detects the language of a synthetic corpus drawn from the trigram frequencies of
+    every language LangDetect supports, and reports the accuracy and throughput of
+    a detector for all of them and of one for the six default languages.
+    """
+    all_detector = LangDetect(languages=None)
+    default_detector = LangDetect([language for language in DEFAULT_LANGUAGES if language in all_detector.languages])
+    all_texts = synthetic_texts(all_detector, all_detector.languages, texts_per_language, words_per_text, seed)
+    default_texts = [(language, text) for language, text in all_texts if language in default_detector.languages]
+
+    results = {}
+    for name, detector, texts in (('all languages', all_detector, all_texts),
+                                  ('default languages', default_detector, default_texts),
+                                  ('all languages, default-language texts', all_detector, default_texts)):
+        elapsed, detected = timed(detector.detect_many, [text for language, text in texts])
+        correct = len([1 for (language, text), (guess, confidence) in zip(texts, detected) if language == guess])
+        results[name] = "%s languages, %s texts, %.1f%% accurate, %.0f texts/s" % \
+            (len(detector.languages), len(texts), 100.0 * correct / len(texts), len(texts) / elapsed)
+    report("Language detection of a synthetic corpus (%s words per text)" % words_per_text, results)
+    return results
+
+
+# The characters of mixed_entity_corpus: letters, characters HTML escapes, and
+# characters outside ASCII, with and without names in htmlentitydefs.
+CORPUS_CHARACTERS = u'abcdefghijklmnopqrstuvwxyz&<>"\'\xe9\xf1\xfc\xa9\u2014\u20ac\u4e2d\u0416'
+
+def escape_character(character, random_state):
+    """ Escapes a character as Google might: by name, as a decimal or hex reference, or not at all. """
+    codepoint = ord(character)
+    choices = ['decimal', 'hex']
+    if codepoint in htmlentitydefs.codepoint2name:
+        choices.append('name')
+    if character not in u'&<':
+        choices.append('literal')
+    choice = random_state.choice(choices)
+    if choice == 'name':
+        return u'&%s;' % htmlentitydefs.codepoint2name[codepoint]
+    if choice == 'decimal':
+        return u'&#%d;' % codepoint
+    if choice == 'hex':
+        return u'&#x%X;' % codepoint
+    return character
+
+def mixed_entity_corpus(words, seed, words_per_chunk=50):
+    """
+    Returns (translated_chunks, text): chunks like the ones Google returns, mixing
+    named, decimal and hex character references with literal characters and <br>s,
+    and the text join_translated_chunks should make of them.
+    """
+    random_state = random.Random(seed)
+    text = []
+    chunks = []
+    chunk = []
+    for i in range(words):
+        if i:
+            separator = random_state.choice([u' ', u' ', u' ', u'\n'])
+            text.append(separator)
+            chunk.append(separator == u'\n' and u'<br>' or u' ')
+            if i % words_per_chunk == 0:
+                chunks.append(u''.join(chunk))
+                chunk = []
+        word = u''.join([random_state.choice(CORPUS_CHARACTERS) for j in range(random_state.randint(1, 8))])
+        text.append(word)
+        chunk.append(u''.join([escape_character(character, random_state) for character in word]))
+    chunks.append(u''.join(chunk))
+    return chunks, u''.join(text)
+
+
+def htmllib_join_translated_chunks(translated_chunks):
+    """ join_translated_chunks as it was, parsing Google's response with htmllib. """
+    translated_text = ''.join(translated_chunks)
+    translated_text = translated_text.replace('<br>', '***fakelinebreak***')
+    p = htmllib.HTMLParser(None)
+    p.save_bgn()
+    p.feed(translated_text)
+    translated_text = p.save_end()
+    return translated_text.replace("***fakelinebreak***", "\n")
+
+
+def benchmark_unescaping(words=(100, 5000, 50000), seed=0):
+    """
+    Measures how long join_translated_chunks takes to unescape translations of
+    several lengths, against the htmllib parser it replaced.
+    """
+    results = {}
+    for n_words in words:
+        chunks, text = mixed_entity_corpus(n_words, seed)
+        encoded_chunks = [chunk.encode('utf-8') for chunk in chunks]
+        repeat = max(1, 100000 / n_words)
+        elapsed, joined = timed(lambda: [utils.join_translated_chunks(chunks) for i in range(repeat)])
+        assert joined[0] == text
+        old_elapsed, old_joined = timed(lambda: [htmllib_join_translated_chunks(encoded_chunks) for i in range(repeat)])
+        results['%6s words' % n_words] = "%.2fms, htmllib %.2fms (%.1fx)" % \
+            (elapsed * 1000 / repeat, old_elapsed * 1000 / repeat, old_elapsed / elapsed)
+    report("Unescaping Google's response", results)
+    return results
+
+
+def run():
+    benchmark_missing_fields()
+    benchmark_translation_throughput()
+    benchmark_error_registry()
+    benchmark_connection_pool()
+    benchmark_translation_indexes()
+    benchmark_language_detection()
+    benchmark_unescaping()
@@ -0,0 +1,209 @@
+"""
+A circuit breaker for the translation provider.
+
+Stops AutoLex from sending requests to Google while Google keeps rejecting them,
+and tries again later instead of staying off until the process restarts.
+
+- Closed: requests are sent. Failures are kept in a bounded ring buffer, and the
+  breaker opens once there have been too many of them too quickly (see THRESHOLDS).
+- Open: no requests are sent for `backoff` seconds.
+- Half-open: once the backoff has passed, a single probe request is let through.
+  If it succeeds the breaker closes; if it fails the breaker opens again for twice
+  as long, up to `max_backoff` seconds.
+
+If settings.GOOGLE_TRANSLATE_SHARED_BREAKER is True, opening the breaker is
+recorded in Django's cache, so that every process stops sending requests, not just
+the one that saw the failures.
+
+Settings:
+ENABLE_GOOGLE_TRANSLATE - if False, the breaker never lets a request through
+GOOGLE_TRANSLATE_BACKOFF - seconds to wait before the first probe (default 60)
+GOOGLE_TRANSLATE_MAX_BACKOFF - the longest wait between probes (default 3600)
+GOOGLE_TRANSLATE_SHARED_BREAKER - share the breaker's state between processes (default False)
+"""
+
+import thread
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+
+
+# The breaker opens after (number of failures, within this many seconds):
+THRESHOLDS = ((5, 5 * 60),        # 5 failures within 5 minutes
+              (20, 60 * 60),      # 20 failures within an hour
+              (50, 24 * 60 * 60)) # 50 failures within a day
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, enabled=True, thresholds=THRESHOLDS, backoff=60, max_backoff=3600,
+                 shared_cache=None, name='google', clock=time.time):
+        """
+        enabled: if False, no request is ever let through
+        thresholds: a list of the form [ (failures, seconds) ]
+        backoff, max_backoff: the first and the longest wait, in seconds, before a probe
+        shared_cache: a Django cache to share the breaker's state through, or None
+        clock: returns the current time in seconds
+        """
+        self.enabled = enabled
+        self.thresholds = thresholds
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.shared_cache = shared_cache
+        self.shared_key = 'autolex:breaker:%s' % name
+        self.clock = clock
+        self.lock = threading.Lock()
+
+        # Only the most recent failures can trip a threshold, so older ones are dropped.
+        self.failures = deque(maxlen=max([count for count, seconds in thresholds]))
+        self.state = CLOSED
+        self.backoff = backoff
+        self.open_until = 0
+        self.probing = False
+        self.prober = None # the thread sending the probe
+
+    def _check_shared_state(self, now):
+        """ Opens the breaker if another process has opened it. The caller must hold the lock. """
+        if self.shared_cache is None or self.state != CLOSED:
+            return
+        shared = self.shared_cache.get(self.shared_key)
+        if shared and shared['open_until'] > now:
+            self.state = OPEN
+            self.open_until = shared['open_until']
+            self.backoff = shared['backoff']
+
+    def _open(self, now):
+        """ Opens the breaker for the current backoff. The caller must hold the lock. """
+        self.state = OPEN
+        self.open_until = now + self.backoff
+        self.probing = False
+        self.prober = None
+        if self.shared_cache is not None:
+            self.shared_cache.set(self.shared_key, {'open_until' : self.open_until, 'backoff' : self.backoff},
+                                  int(self.backoff) + 1)
+
+    def is_available(self):
+        """
+        Returns True if a request could be sent now: the breaker is closed, or it is
+        time for a probe.
+        """
+        if not self.enabled:
+            return False
+        self.lock.acquire()
+        try:
+            now = self.clock()
+            self._check_shared_state(now)
+            if self.state == CLOSED:
+                return True
+            return not self.probing and now >= self.open_until
+        finally:
+            self.lock.release()
+
+    def allow_request(self):
+        """
+        Returns True if a request may be sent now. When the breaker is open and its
+        backoff has passed, the first caller is let through as the probe and the breaker
+        becomes half-open; other callers are turned away until the probe finishes.
+        """
+        if not self.enabled:
+            return False
+        self.lock.acquire()
+        try:
+            now = self.clock()
+            self._check_shared_state(now)
+            if self.state == CLOSED:
+                return True
+            if self.probing or now < self.open_until:
+                return False
+            self.state = HALF_OPEN
+            self.probing = True
+            self.prober = thread.get_ident()
+            return True
+        finally:
+            self.lock.release()
+
+    def finish_request(self):
+        """
+        Called once a request let through by allow_request is over, however it ended.
+        If it was the probe and neither record_success nor record_failure was called,
+        it counts as a failure, so that the breaker never waits on a lost probe.
+        """
+        self.lock.acquire()
+        try:
+            if self.state == HALF_OPEN and self.prober == thread.get_ident():
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+                self._open(self.clock())
+        finally:
+            self.lock.release()
+
+    def record_success(self):
+        """
+        Closes the breaker if this thread's probe succeeded. Other successes change
+        nothing: a request let through before the breaker opened may finish after it did.
+        """
+        self.lock.acquire()
+        try:
+            if self.state == HALF_OPEN and self.prober == thread.get_ident():
+                self.state = CLOSED
+                self.probing = False
+                self.prober = None
+                self.backoff = self.base_backoff
+                self.failures.clear()
+                if self.shared_cache is not None:
+                    self.shared_cache.delete(self.shared_key)
+        finally:
+            self.lock.release()
+
+    def record_failure(self, error=None):
+        """ Records a failed request, opening the breaker if there have been too many. """
+        self.lock.acquire()
+        try:
+            now = self.clock()
+            if self.state == HALF_OPEN:
+                # The probe failed: wait twice as long before the next one.
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+                self._open(now)
+                return
+            if self.state == OPEN:
+                return
+
+            self.failures.append(now)
+            for count, seconds in self.thresholds:
+                if len(self.failures) >= count and now - self.failures[-count] < seconds:
+                    self._open(now)
+                    return
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        """ Closes the breaker and forgets past failures. """
+        self.lock.acquire()
+        try:
+            self.state = CLOSED
+            self.probing = False
+            self.prober = None
+            self.backoff = self.base_backoff
+            self.open_until = 0
+            self.failures.clear()
+            if self.shared_cache is not None:
+                self.shared_cache.delete(self.shared_key)
+        finally:
+            self.lock.release()
+
+
+def get_google_translate_breaker():
+    """ Returns a CircuitBreaker configured from settings. """
+    shared_cache = None
+    if getattr(settings, 'GOOGLE_TRANSLATE_SHARED_BREAKER', False):
+        shared_cache = django_cache
+    return CircuitBreaker(enabled=settings.ENABLE_GOOGLE_TRANSLATE,
+                          backoff=getattr(settings, 'GOOGLE_TRANSLATE_BACKOFF', 60),
+                          max_backoff=getattr(settings, 'GOOGLE_TRANSLATE_MAX_BACKOFF', 3600),
+                          shared_cache=shared_cache)
@@ -0,0 +1,266 @@
+"""
+Translation caches.
+
+get_translated_version and get_translated_versions look translations up here
+before going to the database (see get_cached_translations). Entries are keyed by
+(content_type_id, object_id, field, language) - content_type_id is None when
+translations are shared through settings.COMMON_IDENTIFIER - and hold either the
+translated text or MISSING, which records that there is no translation.
+
+There are two levels:
+
+1. A process-local LRU cache, TRANSLATION_CACHE. Entries expire after
+settings.TRANSLATION_CACHE_TTL seconds (default 300), and the least recently used
+entries are dropped once there are more than settings.TRANSLATION_CACHE_SIZE of
+them (default 10000; 0 disables the cache).
+
+2. If settings.TRANSLATION_SHARED_CACHE is True, a cache shared by every process,
+SHARED_TRANSLATION_CACHE, stored through Django's cache framework (memcached,
+locmem, file, ... - whatever settings.CACHE_BACKEND names). Entries expire after
+settings.TRANSLATION_SHARED_CACHE_TIMEOUT seconds (default 3600).
+
+Saving or deleting a Translation invalidates the entries of its object in both.
+Another process's local cache cannot be reached from the one doing the save, so
+with a shared cache the local entries are also keyed by the object's shared version,
+which is read before each lookup: a local entry is only served while the version it
+was cached under is current. Without a shared cache, each process may keep serving
+a translation changed elsewhere for up to TRANSLATION_CACHE_TTL seconds.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+
+
+# Cached in place of the text when there is no translation.
+MISSING = object()
+
+
+class TranslationCache(object):
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict() # key : (expiry time, value), least recently used first
+        self.keys_by_object = {} # (content_type_id, object_id) : set of keys
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Returns the cached text (or MISSING) for key, or None if key is not cached. """
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._forget(key)
+                self.misses += 1
+                return None
+            # Move the entry to the most recently used end.
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.keys_by_object.setdefault(key[:2], set()).add(key)
+            while len(self.entries) > self.max_size:
+                oldest_key, entry = self.entries.popitem(last=False)
+                self._forget(oldest_key)
+        finally:
+            self.lock.release()
+
+    def _forget(self, key):
+        """ Removes key from keys_by_object. The caller must hold the lock. """
+        keys = self.keys_by_object.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_object[key[:2]]
+
+    def invalidate(self, content_type_id, object_id):
+        """ Drops every cached translation of an object. """
+        self.lock.acquire()
+        try:
+            for key in self.keys_by_object.pop((content_type_id, object_id), ()):
+                self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.keys_by_object.clear()
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """ Returns a dictionary of the form { 'size' : 10, 'hits' : 5, 'misses' : 3 } """
+        return {'size' : len(self.entries), 'hits' : self.hits, 'misses' : self.misses}
+
+
+class SharedTranslationCache(object):
+    """
+    A translation cache stored through Django's cache framework.
+
+    Each object has a version number, stored under its own key, which is part of
+    the keys of all of the object's translations. Invalidating an object
+    increments its version, so its old entries are never read again and simply expire.
+    """
+
+    # Stored in place of MISSING, which cannot be pickled.
+    missing_marker = '__autolex_missing__'
+
+    def __init__(self, cache=None, timeout=3600, prefix='autolex'):
+        if cache is None:
+            cache = django_cache
+        self.cache = cache
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def _version_key(self, object_key):
+        return "%s:version:%s:%s" % ((self.prefix,) + tuple(object_key))
+
+    def _translation_key(self, key, version):
+        return "%s:translation:%s:%s:%s:%s:%s" % ((self.prefix,) + tuple(key) + (version,))
+
+    def _get_versions(self, object_keys):
+        """ Returns { (content_type_id, object_id) : version }, starting a version for new objects. """
+        version_keys = dict([(self._version_key(object_key), object_key) for object_key in object_keys])
+        found = self.cache.get_many(version_keys.keys())
+        versions = {}
+        for version_key, object_key in version_keys.items():
+            if version_key not in found:
+                # Start from the current time rather than 0, so that entries written under
+                # a version that has since been evicted from the cache cannot be read again.
+                self.cache.add(version_key, int(time.time() * 1000), self.timeout)
+                found[version_key] = self.cache.get(version_key)
+            versions[object_key] = found[version_key]
+        return versions
+
+    def get_versions(self, keys):
+        """ Returns { (content_type_id, object_id) : version } for the objects of keys. """
+        return self._get_versions(set([key[:2] for key in keys]))
+
+    def get_many(self, keys, versions=None):
+        """
+        Returns { key : text or MISSING } for the keys that are cached. versions is the
+        result of get_versions(keys), if the caller already has it.
+        """
+        if not keys:
+            return {}
+        if versions is None:
+            versions = self.get_versions(keys)
+        translation_keys = dict([(self._translation_key(key, versions[key[:2]]), key) for key in keys])
+        values = {}
+        for translation_key, value in self.cache.get_many(translation_keys.keys()).items():
+            if value == self.missing_marker:
+                value = MISSING
+            values[translation_keys[translation_key]] = value
+        return values
+
+    def set_many(self, values, versions=None):
+        """ Caches a dictionary of the form { key : text or MISSING } """
+        if not values:
+            return
+        if versions is None:
+            versions = self.get_versions(values.keys())
+        data = {}
+        for key, value in values.items():
+            if value is MISSING:
+                value = self.missing_marker
+            data[self._translation_key(key, versions[key[:2]])] = value
+        self.cache.set_many(data, self.timeout)
+
+    def invalidate(self, content_type_id, object_id):
+        """ Makes every cached translation of an object unreachable. """
+        version_key = self._version_key((content_type_id, object_id))
+        try:
+            self.cache.incr(version_key)
+        except ValueError:
+            # There is no version yet, so nothing has been cached under it.
+            pass
+
+
+TRANSLATION_CACHE = TranslationCache(getattr(settings, 'TRANSLATION_CACHE_SIZE', 10000),
+                                     getattr(settings, 'TRANSLATION_CACHE_TTL', 300))
+
+if getattr(settings, 'TRANSLATION_SHARED_CACHE', False):
+    SHARED_TRANSLATION_CACHE = SharedTranslationCache(timeout=getattr(settings, 'TRANSLATION_SHARED_CACHE_TIMEOUT', 3600))
+else:
+    SHARED_TRANSLATION_CACHE = None
+
+
+def local_key(key, versions):
+    """ Returns the process-local cache key of key, including its object's shared version if there is one. """
+    if versions is None:
+        return key
+    return tuple(key) + (versions[key[:2]],)
+
+
+def get_cached_translations(keys):
+    """
+    Looks keys up in the process-local cache, then in the shared cache.
+
+    ** Output parameters **
+    A dictionary of the form { key : text or MISSING } for the keys found in either
+    cache. Entries found in the shared cache are copied to the process-local one.
+    """
+    if not keys:
+        return {}
+    versions = None
+    if SHARED_TRANSLATION_CACHE is not None:
+        # Process-local entries cached before another process invalidated the object
+        # are under an older version, so they are not found.
+        versions = SHARED_TRANSLATION_CACHE.get_versions(keys)
+
+    values = {}
+    uncached = []
+    for key in keys:
+        value = TRANSLATION_CACHE.get(local_key(key, versions))
+        if value is None:
+            uncached.append(key)
+        else:
+            values[key] = value
+
+    if uncached and SHARED_TRANSLATION_CACHE is not None:
+        for key, value in SHARED_TRANSLATION_CACHE.get_many(uncached, versions).items():
+            TRANSLATION_CACHE.set(local_key(key, versions), value)
+            values[key] = value
+    return values
+
+
+def cache_translations(values):
+    """ Adds a dictionary of the form { key : text or MISSING } to both caches. """
+    versions = None
+    if SHARED_TRANSLATION_CACHE is not None and values:
+        versions = SHARED_TRANSLATION_CACHE.get_versions(values.keys())
+    for key, value in values.items():
+        TRANSLATION_CACHE.set(local_key(key, versions), value)
+    if SHARED_TRANSLATION_CACHE is not None:
+        SHARED_TRANSLATION_CACHE.set_many(values, versions)
+
+
+def invalidate_translation(sender, instance, **kwargs):
+    """
+    Signal handler for Translation saves and deletes. Invalidates the entries of the
+    translation's object, under both its content type and the common identifier.
+    """
+    for object_key in ((instance.content_type_id, instance.object_id), (None, instance.object_id)):
+        TRANSLATION_CACHE.invalidate(*object_key)
+        if SHARED_TRANSLATION_CACHE is not None:
+            SHARED_TRANSLATION_CACHE.invalidate(*object_key)
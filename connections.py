@@ -0,0 +1,122 @@
+"""
+A thread-safe pool of persistent HTTP(S) connections to a single host.
+
+Use as follows:
+pool = HTTPConnectionPool('https://www.googleapis.com', size=4, timeout=10)
+status, headers, body = pool.request('POST', '/language/translate/v2', params, headers)
+
+Connections are kept alive between requests, so the TCP and TLS handshakes are
+only paid once per connection instead of once per request. Errors are raised as
+urllib2.HTTPError (for responses with an error status) or urllib2.URLError (for
+everything else, including timeouts), like urllib2.urlopen.
+"""
+
+import httplib
+import socket
+import threading
+import urllib2
+import urlparse
+import zlib
+import Queue
+from StringIO import StringIO
+
+
+class HTTPConnectionPool(object):
+
+    def __init__(self, url, size=4, timeout=10, gzip=True):
+        """
+        url: the scheme, host and (optionally) port to connect to, e.g. 'https://www.googleapis.com'
+        size: the maximum number of idle connections to keep open
+        timeout: seconds to wait when connecting or reading before giving up
+        gzip: ask the server to compress its responses, and decompress them
+        """
+        parsed = urlparse.urlparse(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.size = size
+        self.timeout = timeout
+        self.gzip = gzip
+        self.idle = Queue.LifoQueue(maxsize=max(size, 1))
+        self.lock = threading.Lock()
+        self.connections_opened = 0
+
+    def _new_connection(self):
+        self.lock.acquire()
+        try:
+            self.connections_opened += 1
+        finally:
+            self.lock.release()
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _get_connection(self):
+        """ Returns (connection, reused) - an idle connection if there is one, otherwise a new one. """
+        try:
+            return self.idle.get_nowait(), True
+        except Queue.Empty:
+            return self._new_connection(), False
+
+    def _release_connection(self, connection):
+        if self.size <= 0:
+            connection.close()
+            return
+        try:
+            self.idle.put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Sends a request and returns (status, headers, body) for a successful response.
+        A request on a kept-alive connection that the server has since closed is
+        retried once on a new connection.
+        """
+        headers = dict(headers or {})
+        if self.gzip:
+            headers['Accept-Encoding'] = 'gzip'
+
+        connection, reused = self._get_connection()
+        while True:
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    # httplib sends the headers and the body separately; without this,
+                    # Nagle's algorithm holds the body back for every kept-alive request.
+                    connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if reused and not isinstance(e, socket.timeout):
+                    connection, reused = self._new_connection(), False
+                    continue
+                raise urllib2.URLError(e)
+
+        response_headers = dict(response.getheaders())
+        if response.will_close:
+            connection.close()
+        else:
+            self._release_connection(connection)
+
+        if response_headers.get('content-encoding') == 'gzip':
+            try:
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            except zlib.error, e:
+                raise urllib2.URLError(e)
+
+        if response.status >= 400:
+            url = "%s://%s%s" % (self.scheme, self.host, path)
+            raise urllib2.HTTPError(url, response.status, response.reason, response_headers, StringIO(data))
+        return response.status, response_headers, data
+
+    def close(self):
+        """ Closes all of the idle connections. """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
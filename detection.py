@@ -6,18 +6,46 @@ text = "Text string in any language."
 ld = LangDetect()
 language_code = ld.detect(text)
 
-Currently supports Dutch, English, French, German, Russian, and Spanish.
-Add support for additional languages by adding their language codes to the
-dictionary in line 55.
+To detect the language of many texts at once:
+[(language_code, confidence), ...] = ld.detect_many(texts)
+
+For the ranked languages, their normalized scores and the margin between the
+first two (see DetectionResult), optionally reading only as much of a long text
+as it takes for the margin to reach 0.5:
+result = ld.analyze(text, margin=0.5)
+
+Detects Dutch, English, French, German, Russian, and Spanish by default. Pass
+other language codes to LangDetect, or languages=None for every language of
+models.LANGUAGE_CHOICES that the langid corpus covers.
+
+Reading the trigram frequencies from the langid corpus takes seconds, so they can
+be compiled once into a model directory (settings.LANGDETECT_MODEL, by default the
+langid_model directory next to this file):
+python manage.py compile_langdetect_model
+
+The model holds NumPy arrays of the language codes, the sorted trigram
+vocabulary and, for each trigram, the languages it occurs in with its relative
+frequency in each (see Postings). LangDetect memory-maps them, so it loads in
+milliseconds and forked workers share the pages. Without a compiled model,
+LangDetect reads the corpus as before.
 """
 
+import os
+
+import numpy as np
+from django.conf import settings
 from nltk.util import trigrams as nltk_trigrams
 from nltk.tokenize import word_tokenize as nltk_word_tokenize
-from nltk.probability import FreqDist
 from nltk.corpus.util import LazyCorpusLoader
 from nltk.corpus.reader.api import CorpusReader
 from nltk.corpus.reader.util import StreamBackedCorpusView, concat
 
+DEFAULT_LANGUAGES = ['nl', 'en', 'fr', 'de', 'es', 'ru']
+
+# Languages whose code in the langid corpus differs from models.LANGUAGE_CHOICES
+CORPUS_CODES = {'iw' : 'he'}
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(__file__), 'langid_model')
+
 class LangIdCorpusReader(CorpusReader):
     '''
     LangID corpus reader
@@ -48,38 +76,286 @@ class LangIdCorpusReader(CorpusReader):
         return concat([self.CorpusView(path, self._read_trigram_block)
                        for path in self.abspaths(fileids=fileids)])
 
+langid = LazyCorpusLoader('langid', LangIdCorpusReader, r'(?!\.).*\.txt')
+
+def get_model_path():
+    return getattr(settings, 'LANGDETECT_MODEL', DEFAULT_MODEL_PATH)
+
+def corpus_languages():
+    '''
+    Return the codes (as in models.LANGUAGE_CHOICES) of the languages in the langid corpus
+    '''
+    codes = [fileid[:-len("-3grams.txt")] for fileid in langid.fileids() if fileid.endswith("-3grams.txt")]
+    aliases = dict([(corpus_code, code) for code, corpus_code in CORPUS_CODES.items()])
+    return sorted([aliases.get(code, code) for code in codes])
+
+def utf8(trigram):
+    '''
+    Return a trigram as a UTF-8 byte string, the form the vocabulary holds
+    '''
+    if isinstance(trigram, unicode):
+        return trigram.encode('utf-8')
+    return trigram
+
+def read_corpus(languages):
+    '''
+    Read the trigram frequencies of languages from the langid corpus and return
+    (languages, sorted trigram vocabulary, postings) - see Postings
+    '''
+    counts = []
+    for lang in languages:
+        lang_counts = {}
+        for trigram, count in langid.freqs(fileids=CORPUS_CODES.get(lang, lang)+"-3grams.txt"):
+            trigram = utf8(trigram)
+            lang_counts[trigram] = lang_counts.get(trigram, 0) + count
+        counts.append(lang_counts)
+
+    vocabulary = set()
+    for lang_counts in counts:
+        vocabulary.update(lang_counts.keys())
+    vocabulary = sorted(vocabulary)
+    index = dict([(trigram, i) for i, trigram in enumerate(vocabulary)])
+
+    rows = []
+    posting_languages = []
+    posting_weights = []
+    for column, lang_counts in enumerate(counts):
+        total = float(sum(lang_counts.values()))
+        for trigram, count in lang_counts.items():
+            rows.append(index[trigram])
+            posting_languages.append(column)
+            posting_weights.append(count / total)
+    return np.array(languages), np.array(vocabulary, dtype=str), \
+        Postings.from_entries(len(vocabulary), rows, posting_languages, posting_weights)
+
+def compile_model(path=None, languages=None):
+    '''
+    Compile the trigram frequencies of languages (by default, every language in the
+    langid corpus) into a model directory that LangDetect can memory-map
+    '''
+    if path is None:
+        path = get_model_path()
+    if languages is None:
+        languages = corpus_languages()
+    languages, vocabulary, postings = read_corpus(languages)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, 'languages.npy'), languages)
+    np.save(os.path.join(path, 'trigrams.npy'), vocabulary)
+    np.save(os.path.join(path, 'indptr.npy'), postings.indptr)
+    np.save(os.path.join(path, 'posting_languages.npy'), postings.languages)
+    np.save(os.path.join(path, 'posting_weights.npy'), postings.weights)
+    return path
+
+def load_model(path):
+    '''
+    Memory-map a model directory written by compile_model
+    '''
+    return (np.load(os.path.join(path, 'languages.npy')),
+            np.load(os.path.join(path, 'trigrams.npy'), mmap_mode='r'),
+            Postings(np.load(os.path.join(path, 'indptr.npy'), mmap_mode='r'),
+                     np.load(os.path.join(path, 'posting_languages.npy'), mmap_mode='r'),
+                     np.load(os.path.join(path, 'posting_weights.npy'), mmap_mode='r')))
+
+class Postings(object):
+    '''
+    For each trigram in the vocabulary, the languages it occurs in and its relative
+    frequency in each: the postings of trigram i are languages[indptr[i]:indptr[i+1]]
+    and weights[indptr[i]:indptr[i+1]]. Most trigrams only occur in a few languages,
+    so scoring a text touches far fewer entries than a (trigrams x languages) matrix.
+    '''
+
+    def __init__(self, indptr, languages, weights):
+        self.indptr = indptr
+        self.languages = languages
+        self.weights = weights
+
+    @classmethod
+    def from_entries(cls, n_trigrams, rows, languages, weights):
+        '''
+        Build the postings from parallel lists of (trigram row, language, weight) entries
+        '''
+        rows = np.array(rows, dtype=np.int64)
+        order = np.argsort(rows, kind='mergesort')
+        indptr = np.zeros(n_trigrams + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_trigrams), out=indptr[1:])
+        return cls(indptr, np.array(languages, dtype=np.int32)[order], np.array(weights)[order])
+
+    def gather(self, rows):
+        '''
+        Return (positions, languages, weights) of the postings of each of rows, where
+        positions are the indexes into rows the postings belong to
+        '''
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        positions = np.repeat(np.arange(len(rows)), lengths)
+        # Index of every posting: its row's start plus its offset within the row.
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        entries = np.repeat(starts, lengths) + offsets
+        return positions, self.languages[entries], self.weights[entries]
+
+class DetectionResult(object):
+    '''
+    The outcome of LangDetect.analyze:
+    ranked - (language, score) pairs, best first; the scores are normalized to sum to 1
+    language, confidence - the best language and its score
+    margin - how far the best language's score is ahead of the second best
+    characters_read - how much of the text was read before stopping
+    '''
+
+    def __init__(self, languages, scores, characters_read):
+        total = float(sum(scores))
+        if total:
+            normalized = [score / total for score in scores]
+        else:
+            normalized = [0.0] * len(languages)
+        self.ranked = sorted(zip(languages, normalized), key=lambda x: x[1], reverse=True)
+        self.language, self.confidence = self.ranked[0]
+        if len(self.ranked) > 1:
+            self.margin = self.confidence - self.ranked[1][1]
+        else:
+            self.margin = self.confidence
+        self.characters_read = characters_read
+
+    def top(self, k):
+        '''
+        Return the k best (language, score) pairs
+        '''
+        return self.ranked[:k]
+
+    def __repr__(self):
+        return "<DetectionResult %s (confidence %.2f, margin %.2f)>" % (self.language, self.confidence, self.margin)
+
 class LangDetect(object):
-    language_trigrams = {}
-    langid            = LazyCorpusLoader('langid', LangIdCorpusReader, r'(?!\.).*\.txt')
 
-    def __init__(self, languages=['nl', 'en', 'fr', 'de', 'es', 'ru']):
-        for lang in languages:
-            self.language_trigrams[lang] = FreqDist()
-            for f in self.langid.freqs(fileids=lang+"-3grams.txt"):
-                self.language_trigrams[lang].inc(f[0], f[1])
+    def __init__(self, languages=DEFAULT_LANGUAGES, model_path=None):
+        if model_path is None:
+            model_path = get_model_path()
+        model_languages = []
+        if os.path.exists(os.path.join(model_path, 'indptr.npy')):
+            model_languages, self.trigrams, self.postings = load_model(model_path)
+            model_languages = list(model_languages)
+
+        if languages is None:
+            # Every language that can be a translation target and that we have trigrams for.
+            from autolex.models import LANGUAGE_CHOICES
+            available = model_languages or corpus_languages()
+            languages = [code for code, name in LANGUAGE_CHOICES if code in available]
+
+        if [lang for lang in languages if lang not in model_languages]:
+            # No compiled model, or it lacks some of the languages: read the corpus.
+            model_languages, self.trigrams, self.postings = read_corpus(list(languages))
+            model_languages = list(model_languages)
+
+        self.languages = list(languages)
+        self.model_languages = model_languages
+        self.columns = [model_languages.index(lang) for lang in self.languages]
 
     def detect(self, text):
         '''
         Detect the text's language
         '''
-        words    = nltk_word_tokenize(text.lower())
-        trigrams = {}
-        scores   = dict([(lang, 0) for lang in self.language_trigrams.keys()])
+        scores = self.score_texts([text])[0]
+        return self.languages[int(np.argmax(scores))]
 
-        for match in words:
+    def detect_many(self, texts, batch_size=1000):
+        '''
+        Detect the language of each of a list of texts. Returns a list of
+        (language, confidence) pairs, where confidence is the best language's
+        share of the text's total score (0 if no trigram was recognised).
+        '''
+        results = []
+        for start in range(0, len(texts), batch_size):
+            scores = self.score_texts(texts[start:start + batch_size])
+            best = np.argmax(scores, axis=1)
+            totals = scores.sum(axis=1)
+            for i in range(len(scores)):
+                confidence = totals[i] and scores[i, best[i]] / totals[i] or 0.0
+                results.append((self.languages[best[i]], float(confidence)))
+        return results
+
+    def count_trigrams(self, text):
+        '''
+        Count the trigrams of the words of a text
+        '''
+        if isinstance(text, str):
+            # Trigrams are of characters, not of the bytes of UTF-8 text. Text in
+            # another encoding is counted byte by byte, as it always was.
+            try:
+                text = text.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        trigrams = {}
+        for match in nltk_word_tokenize(text.lower()):
             for trigram in self.get_word_trigrams(match):
-                if not trigram in trigrams.keys():
-                    trigrams[trigram] = 0
-                trigrams[trigram] += 1
+                trigrams[trigram] = trigrams.get(trigram, 0) + 1
+        return trigrams
+
+    def analyze(self, text, margin=None, block_size=2000):
+        '''
+        Detect the text's language and return a DetectionResult.
 
-        total = sum(trigrams.values())
+        With a margin, the text is read block_size characters at a time (without
+        splitting words), and reading stops as soon as the best language leads the
+        second by at least margin, so long texts cost no more than needed.
+        '''
+        if margin is None:
+            return DetectionResult(self.languages, self.score_texts([text])[0], len(text))
+
+        scores = np.zeros(len(self.languages))
+        result = DetectionResult(self.languages, scores, 0)
+        position = 0
+        while position < len(text):
+            end = position + block_size
+            while end < len(text) and not text[end].isspace():
+                end += 1
+            scores = scores + self.score_counts([self.count_trigrams(text[position:end])], normalize=False)[0]
+            position = end
+            result = DetectionResult(self.languages, scores, position)
+            if result.margin >= margin:
+                break
+        return result
+
+    def score_texts(self, texts):
+        '''
+        Score each text in each language: the sum of the relative frequency of each
+        of the text's trigrams in the language, weighted by its share of the text's
+        trigrams. Returns a (texts x self.languages) array.
+        '''
+        return self.score_counts([self.count_trigrams(text) for text in texts])
+
+    def score_counts(self, counts, normalize=True):
+        '''
+        Score a list of trigram counts (see count_trigrams) in each language. Without
+        normalize, trigrams are weighted by their count rather than their share of
+        the text's trigrams.
 
-        for trigram, count in trigrams.items():
-            for lang, frequencies in self.language_trigrams.items():
-                # normalize and add to the total score
-                scores[lang] += (float(frequencies[trigram]) / float(frequencies.N())) * (float(count) / float(total))
+        The counts form a sparse (texts x vocabulary) matrix, held as (text, vocabulary
+        row, weight) triples; multiplying it by the postings (a sparse vocabulary x
+        languages matrix) is a gather of the matching postings followed by a
+        scatter-add per (text, language), so the cost depends on how many languages
+        each trigram occurs in rather than on how many languages there are.
+        '''
+        texts_index = []
+        keys = []
+        weights = []
+        for i, trigrams in enumerate(counts):
+            total = normalize and float(sum(trigrams.values())) or 1.0
+            for trigram, count in trigrams.items():
+                texts_index.append(i)
+                keys.append(utf8(trigram))
+                weights.append(count / total)
 
-        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[0][0]
+        scores = np.zeros((len(counts), len(self.model_languages)))
+        if keys and len(self.trigrams):
+            keys = np.array(keys, dtype=str)
+            rows = np.searchsorted(self.trigrams, keys)
+            rows[rows == len(self.trigrams)] = 0
+            found = self.trigrams[rows] == keys
+            positions, languages, frequencies = self.postings.gather(rows[found])
+            contributions = np.array(weights)[found][positions] * frequencies
+            np.add.at(scores, (np.array(texts_index)[found][positions], languages), contributions)
+        return scores[:, self.columns]
 
     def get_word_trigrams(self, match):
         return [''.join(trigram) for trigram in nltk_trigrams(match) if trigram != None]
@@ -0,0 +1,149 @@
+"""
+Single-flight fetching of Google translations.
+
+When a new item appears on a busy page, every request rendering it finds the same
+fields missing. translate_missing_fields claims each field before fetching it, so
+only one caller fetches a given (object, field, language) at a time:
+
+- Within a process, the first thread to claim a key fetches it. Other threads
+  wait (up to settings.TRANSLATION_FLIGHT_WAIT seconds, default 10) for it to finish,
+  so they can show the new translation.
+- Across processes, claims are TranslationClaim rows with a unique key. A caller
+  whose insert fails skips the field: the process holding the claim will save the
+  translation, and until then get_translated_version falls back on the original text.
+  Claims left behind by a process that died are ignored after
+  settings.TRANSLATION_CLAIM_TIMEOUT seconds (default 300).
+
+Use as follows:
+flight = Flight(keys)
+try:
+    ... fetch and save the translations of flight.claimed ...
+finally:
+    flight.release()
+flight.wait()
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils.encoding import smart_str
+
+from autolex.models import TranslationClaim
+
+
+def get_flight_wait():
+    return getattr(settings, 'TRANSLATION_FLIGHT_WAIT', 10)
+
+def get_claim_timeout():
+    return timedelta(seconds=getattr(settings, 'TRANSLATION_CLAIM_TIMEOUT', 300))
+
+
+class InFlight(object):
+    """ The keys being fetched by the threads of this process. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {} # key : threading.Event set when the fetch finishes
+
+    def claim(self, keys):
+        """
+        Claims the keys nobody in this process is fetching.
+
+        ** Output parameters **
+        (claimed, waiting): a list of the keys claimed, and a dictionary of the form
+        { key : event } for the keys another thread is fetching.
+        """
+        claimed = []
+        waiting = {}
+        self.lock.acquire()
+        try:
+            for key in keys:
+                if key in claimed:
+                    # A duplicate of a key this call has just claimed
+                    continue
+                if key in self.events:
+                    waiting[key] = self.events[key]
+                else:
+                    self.events[key] = threading.Event()
+                    claimed.append(key)
+        finally:
+            self.lock.release()
+        return claimed, waiting
+
+    def release(self, keys):
+        """ Releases claimed keys and wakes up the threads waiting for them. """
+        self.lock.acquire()
+        try:
+            for key in keys:
+                event = self.events.pop(key, None)
+                if event is not None:
+                    event.set()
+        finally:
+            self.lock.release()
+
+IN_FLIGHT = InFlight()
+
+
+def claim_hash(key):
+    return hashlib.sha1(smart_str(u"%s:%s:%s:%s" % key)).hexdigest()
+
+@transaction.commit_on_success
+def claim_in_database(keys, token):
+    """ Inserts a TranslationClaim for each key and returns the keys whose insert succeeded. """
+    now = datetime.now()
+    hashes = dict([(claim_hash(key), key) for key in keys])
+    # Ignore claims left behind by processes that died.
+    TranslationClaim.objects.filter(key__in=hashes.keys(), claimed_at__lt=now - get_claim_timeout()).delete()
+
+    claimed = []
+    for hash, key in hashes.items():
+        sid = transaction.savepoint()
+        try:
+            TranslationClaim.objects.create(key=hash, claimed_by=token, claimed_at=now)
+            transaction.savepoint_commit(sid)
+            claimed.append(key)
+        except IntegrityError:
+            # Another process is fetching this translation.
+            transaction.savepoint_rollback(sid)
+    return claimed
+
+@transaction.commit_on_success
+def release_in_database(token):
+    TranslationClaim.objects.filter(claimed_by=token).delete()
+
+
+class Flight(object):
+    """ The claims of one caller of translate_missing_fields. """
+
+    def __init__(self, keys):
+        self.token = uuid.uuid4().hex
+        claimed, self.waiting = IN_FLIGHT.claim(keys)
+        self.claimed = set(claim_in_database(claimed, self.token)) if claimed else set()
+        # Keys claimed by another process are skipped.
+        self.skipped = set(claimed) - self.claimed
+        IN_FLIGHT.release(self.skipped)
+
+    def release(self):
+        """ Releases the claims once the translations have been saved (or have failed). """
+        if self.claimed:
+            release_in_database(self.token)
+        IN_FLIGHT.release(self.claimed)
+
+    def wait(self, timeout=None):
+        """
+        Waits up to `timeout` seconds (settings.TRANSLATION_FLIGHT_WAIT by default) for
+        the other threads of this process fetching keys we wanted.
+        """
+        if timeout is None:
+            timeout = get_flight_wait()
+        deadline = time.time() + timeout
+        for event in self.waiting.values():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            event.wait(remaining)
@@ -0,0 +1,68 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from autolex.backfill import Backfill
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "unknown"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class Command(BaseCommand):
+    help = "Translates every TranslatedItem into a language, resuming from a checkpoint (see autolex.backfill)."
+    args = '<language>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--models', dest='models', default=None,
+                    help='Comma-separated app_label.Model names to backfill. Defaults to every TranslatedItem model.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=200,
+                    help='Number of objects to read at a time.'),
+        make_option('--characters-per-second', type='float', dest='characters_per_second', default=None,
+                    help='Characters to send to Google per second. Defaults to settings.BACKFILL_CHARACTERS_PER_SECOND.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='JSON file recording progress. Defaults to backfill_<language>.json.'),
+        make_option('--ip-address', dest='ip_address', default='127.0.0.1',
+                    help='The IP address to send Google with each request.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: backfill_translations %s" % self.args)
+        language = args[0]
+        verbosity = int(options.get('verbosity', 1))
+
+        models = None
+        if options['models']:
+            models = []
+            for label in options['models'].split(','):
+                model = '.' in label and get_model(*label.split('.', 1)) or None
+                if model is None:
+                    raise CommandError("Unknown model: %s" % label)
+                models.append(model)
+
+        def report(progress):
+            if verbosity > 0:
+                self.stdout.write("%(objects)s/%(total)s objects, %(fields)s fields translated, %(failed)s failed " % progress
+                                  + "(%.1f objects/s, %.0f characters/s, ETA %s)\n" %
+                                  (progress['objects_per_second'], progress['characters_per_second'],
+                                   format_seconds(progress['eta'])))
+
+        try:
+            backfill = Backfill(language, options['ip_address'], models=models, batch_size=options['batch_size'],
+                                characters_per_second=options['characters_per_second'],
+                                checkpoint_path=options['checkpoint'] or 'backfill_%s.json' % language,
+                                report=report)
+        except ValueError, e:
+            # The checkpoint is for another language.
+            raise CommandError(str(e))
+        if not backfill.run():
+            raise CommandError("Google Translate is disabled; run the command again to resume.")
+        if verbosity > 0:
+            self.stdout.write("Backfilled %s fields into %s (%s failed).\n" % (backfill.fields_translated, language,
+                                                                              backfill.fields_failed))
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from autolex.detection import compile_model
+
+
+class Command(NoArgsCommand):
+    help = "Compiles the langid trigram corpus into the model LangDetect loads (see autolex.detection)."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+                    help='Directory to write the model to. Defaults to settings.LANGDETECT_MODEL.'),
+        make_option('--languages', dest='languages', default=None,
+                    help='Comma-separated language codes to compile. Defaults to every language in the corpus.'),
+    )
+
+    def handle_noargs(self, **options):
+        languages = None
+        if options['languages']:
+            languages = options['languages'].split(',')
+        path = compile_model(options['output'], languages)
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Wrote the language detection model to %s.\n" % path)
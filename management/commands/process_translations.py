@@ -0,0 +1,28 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from autolex.tasks import process_all_translation_jobs
+
+
+class Command(NoArgsCommand):
+    help = "Processes the background translation queue (see autolex.tasks)."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=100,
+                    help='Number of jobs to claim at a time.'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Keep waiting for new jobs once the queue is empty.'),
+        make_option('--interval', type='int', dest='interval', default=5,
+                    help='Seconds to wait between checks for new jobs when looping.'),
+    )
+
+    def handle_noargs(self, **options):
+        while True:
+            processed = process_all_translation_jobs(options['limit'])
+            if int(options.get('verbosity', 1)) > 0 and processed:
+                self.stdout.write("Processed %s translation jobs.\n" % processed)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,124 @@
+"""
+Translation memory.
+
+The same text often appears in many objects - signatures, standard titles,
+repeated comments, shared paragraphs of long documents. translate_chunks looks
+every chunk up here before sending it to Google, and remembers the chunks Google
+translates, so each distinct chunk is only translated once per pair of languages.
+
+Entries are TranslationMemoryEntry rows keyed by a hash of (chunk, source language,
+target language), and hold Google's translation of the chunk as it was returned,
+before join_translated_chunks unescapes it.
+
+Settings:
+TRANSLATION_MEMORY - look chunks up in the translation memory (default True)
+
+memory_stats() reports how many chunks were found in the memory in this process.
+"""
+
+import hashlib
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils.encoding import smart_str
+
+from autolex.models import TranslationMemoryEntry
+
+
+# How many keys to look up in one query
+LOOKUP_BATCH_SIZE = 500
+
+
+def memory_enabled():
+    return getattr(settings, 'TRANSLATION_MEMORY', True)
+
+
+def memory_key(chunk, source_language, target_language):
+    """ Returns the key of a chunk's translation from source_language into target_language. """
+    return hashlib.sha1("%s\0%s\0%s" % (smart_str(source_language), smart_str(target_language),
+                                        smart_str(chunk))).hexdigest()
+
+
+class MemoryStats(object):
+    """ Counts the chunks found and not found in the translation memory. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hits, misses):
+        self.lock.acquire()
+        try:
+            self.hits += hits
+            self.misses += misses
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self.lock.release()
+
+MEMORY_STATS = MemoryStats()
+
+def memory_stats():
+    """ Returns a dictionary of the form { 'hits' : 30, 'misses' : 10, 'hit_rate' : 0.75 } """
+    hits, misses = MEMORY_STATS.hits, MEMORY_STATS.misses
+    lookups = hits + misses
+    return {'hits' : hits, 'misses' : misses, 'hit_rate' : lookups and float(hits) / lookups or 0.0}
+
+
+def recall_translations(keys):
+    """
+    Looks chunks up in the translation memory.
+
+    ** Input Parameters **
+    keys: a list of keys from memory_key
+
+    ** Output Parameters **
+    A dictionary of the form { key : translated chunk } for the keys that were found.
+    """
+    keys = list(set(keys))
+    found = {}
+    for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+        rows = TranslationMemoryEntry.objects.filter(key__in=keys[i:i + LOOKUP_BATCH_SIZE])
+        found.update(rows.values_list('key', 'translation'))
+    MEMORY_STATS.record(len(found), len(keys) - len(found))
+    return found
+
+
+@transaction.commit_on_success
+def _insert_entries(entries):
+    existing = set(TranslationMemoryEntry.objects.filter(key__in=[entry.key for entry in entries])
+                   .values_list('key', flat=True))
+    new = [entry for entry in entries if entry.key not in existing]
+    # bulk_create does not call TranslationMemoryEntry.save, so set the timestamps here.
+    now = datetime.now()
+    for entry in new:
+        entry.created_at = now
+    TranslationMemoryEntry.objects.bulk_create(new)
+
+def remember_translations(translations):
+    """
+    Adds translated chunks to the translation memory.
+
+    ** Input Parameters **
+    translations: a list of the form [ (key, source_language, target_language, translated chunk) ]
+    """
+    entries = {}
+    for key, source_language, target_language, translated_chunk in translations:
+        entries[key] = TranslationMemoryEntry(key=key, source_language=source_language,
+                                              target_language=target_language, translation=translated_chunk)
+    entries = entries.values()
+    for i in range(0, len(entries), LOOKUP_BATCH_SIZE):
+        try:
+            _insert_entries(entries[i:i + LOOKUP_BATCH_SIZE])
+        except IntegrityError:
+            # Another process remembered some of the same chunks at the same time.
+            pass
@@ -9,6 +9,7 @@ import uuid
 # Django imports
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.utils import translation
@@ -16,6 +17,9 @@ from util.middleware.threadlocals import get_current_user
 
 # Project imports
 from django.conf import settings
+from autolex.cache import invalidate_translation
+from autolex.autodetect import detect_language_on_save
+from autolex.retranslate import retranslate_on_save
 
 
 def get_google_translate_user():
@@ -144,6 +148,7 @@ class Translation(models.Model):
 
     class Meta:
         db_table="community_translation"
+        # The composite indexes for translation lookups are created by sql/translation*.sql
 
     # Core properties
     translation = models.TextField()
@@ -153,6 +158,8 @@ class Translation(models.Model):
 
     # Google properties
     from_google = models.BooleanField(default=False)
+    # A hash of the text Google translated, to tell when it changes (see autolex.retranslate)
+    source_hash = models.CharField(max_length=40, editable=False, blank=True, null=True)
 
     # An implementation of a Generic Foreign Key (see Django's contenttypes framework)
     content_type = models.ForeignKey(ContentType)
@@ -178,11 +185,137 @@ class Translation(models.Model):
         self.last_modified_at = datetime.now()
         super(Translation, self).save(force_insert, force_update)
 
+# Keep the process-local translation cache (see autolex.cache) up to date.
+post_save.connect(invalidate_translation, sender=Translation)
+post_delete.connect(invalidate_translation, sender=Translation)
+
+class TranslationJob(models.Model):
+    """
+    A field waiting to be translated by a background worker (see autolex.tasks).
+    Jobs are deleted once the translation has been saved.
+    """
+
+    class Meta:
+        db_table="community_translationjob"
+
+    # The field to translate
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    object = generic.GenericForeignKey()
+    field = models.CharField(max_length=255)
+    language = models.CharField(max_length=5, choices=LANGUAGE_CHOICES)
+
+    # The IP address of the user whose request created the job. Needed to contact Google.
+    ip_address = models.CharField(max_length=39)
+
+    # Workers claim jobs by writing a unique token to claimed_by.
+    claimed_by = models.CharField(max_length=64, editable=False, blank=True, null=True)
+    claimed_at = models.DateTimeField(editable=False, blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0, editable=False)
+
+    created_at = models.DateTimeField(editable=False)
+
+    def save(self, force_insert=False, force_update=False):
+        if not self.pk:
+            self.created_at = datetime.now()
+        super(TranslationJob, self).save(force_insert, force_update)
+
+class TranslationClaim(models.Model):
+    """
+    A translation being fetched from Google by some process (see autolex.flight).
+    The unique key stops two processes from fetching the same translation at once.
+    """
+
+    class Meta:
+        db_table="community_translationclaim"
+
+    # A hash of the (content type id, object id, field, language) of the translation
+    key = models.CharField(max_length=40, unique=True)
+    claimed_by = models.CharField(max_length=64)
+    claimed_at = models.DateTimeField()
+
+class TranslationMemoryEntry(models.Model):
+    """
+    A translated chunk of text, shared by every object containing the same chunk
+    (see autolex.memory).
+    """
+
+    class Meta:
+        db_table="community_translationmemory"
+
+    # A hash of the chunk, the source language and the target language
+    key = models.CharField(max_length=40, unique=True)
+    source_language = models.CharField(max_length=5, choices=LANGUAGE_CHOICES)
+    target_language = models.CharField(max_length=5, choices=LANGUAGE_CHOICES)
+    translation = models.TextField()
+    created_at = models.DateTimeField(editable=False)
+
+    def save(self, force_insert=False, force_update=False):
+        if not self.pk:
+            self.created_at = datetime.now()
+        super(TranslationMemoryEntry, self).save(force_insert, force_update)
+
+# How many objects TranslatedQuerySet looks up translations for at once
+PREFETCH_BATCH_SIZE = 1000
+
+class TranslatedQuerySet(models.query.QuerySet):
+    """
+    A QuerySet of TranslatedItems. with_translations attaches the objects' translations
+    as they are fetched, so that object.translated(field) does not query the database.
+
+    The translations are looked up through get_translated_versions rather than with
+    prefetch_related('translations'): it answers from the translation caches before
+    querying, and it finds translations shared through settings.COMMON_IDENTIFIER,
+    whose object_id is not the object's primary key that the GenericRelation joins on.
+    """
+    prefetch_language = None
+    prefetch_fields = None
+    prefetching = False
+
+    def with_translations(self, language=None, fields=None):
+        """
+        language: the language to translate into (default: the current language)
+        fields: the fields to translate (default: each object's translated_fields)
+        """
+        return self._clone(prefetching=True, prefetch_language=language, prefetch_fields=fields)
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        for name in ('prefetching', 'prefetch_language', 'prefetch_fields'):
+            kwargs.setdefault(name, getattr(self, name))
+        return super(TranslatedQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def iterator(self):
+        if not self.prefetching:
+            for object in super(TranslatedQuerySet, self).iterator():
+                yield object
+            return
+
+        from autolex.utils import prefetch_translations
+        batch = []
+        for object in super(TranslatedQuerySet, self).iterator():
+            batch.append(object)
+            if len(batch) == PREFETCH_BATCH_SIZE:
+                for object in prefetch_translations(batch, self.prefetch_language, self.prefetch_fields):
+                    yield object
+                batch = []
+        for object in prefetch_translations(batch, self.prefetch_language, self.prefetch_fields):
+            yield object
+
+class TranslatedManager(models.Manager):
+    """ Use as follows: Story.objects.filter(...).with_translations('es') """
+    def get_query_set(self):
+        return TranslatedQuerySet(self.model, using=self._db)
+
+    def with_translations(self, language=None, fields=None):
+        return self.get_query_set().with_translations(language, fields)
+
 class TranslatedItem(models.Model):
 
     class Meta:
         abstract = True
 
+    objects = TranslatedManager()
+
     language = models.CharField(max_length=5, choices=LANGUAGE_CHOICES)
 
     def get_translated_fields(self):
@@ -194,6 +327,19 @@ class TranslatedItem(models.Model):
 
     translations = generic.GenericRelation(Translation)
 
+    def translated(self, field_name, to_language=None):
+        """
+        Returns the translated version of a field (see get_translated_version), using the
+        translations attached by with_translations or prefetch_translations if there are any.
+        """
+        if not to_language:
+            to_language = translation.get_language()
+        prefetched = self.__dict__.setdefault('_translated_versions', {})
+        if (field_name, to_language) not in prefetched:
+            from autolex.utils import get_translated_version
+            prefetched[(field_name, to_language)] = get_translated_version(self, field_name, to_language)
+        return prefetched[(field_name, to_language)]
+
     #def translation_creator(self, field="text", to_language=None):
     #    if not to_language:
     #        to_language = translation.get_language()
@@ -202,24 +348,71 @@ class TranslatedItem(models.Model):
     #    except:
     #        return "No Translator"
 
-    def translated_by_google(self, field="text",to_language=None):
+    def get_translation(self, field="text", to_language=None):
+        """
+        Returns the Translation of a field, or None if there is none. If a field has
+        several, the most recent active one is returned.
+
+        The first call for a language looks up the translations of all of the object's
+        translated fields in one query; the object remembers them for later calls.
+        """
         if not to_language:
             to_language = translation.get_language()
-        return self.translations.get(field=field, language=to_language).from_google
+        looked_up = self.__dict__.setdefault('_translation_objects', {})
+        google = self.__dict__.setdefault('_google_translation_objects', {})
+        if (field, to_language) not in looked_up:
+            fields = set(self.translated_fields)
+            fields.add(field)
+            for field_name in fields:
+                looked_up[(field_name, to_language)] = None
+                google[(field_name, to_language)] = None
+            # Active and most recent last, so that they are the ones remembered.
+            for t in self.translations.filter(field__in=fields, language=to_language) \
+                    .order_by('is_active', 'last_modified_at'):
+                looked_up[(t.field, to_language)] = t
+                if t.from_google:
+                    google[(t.field, to_language)] = t
+        return looked_up[(field, to_language)]
+
+    def translated_by_google(self, field="text",to_language=None):
+        t = self.get_translation(field, to_language)
+        if t is None:
+            raise Translation.DoesNotExist("There is no translation of the %s field." % field)
+        return t.from_google
 
     def google_translation_date(self, field="text", to_language=None):
+        """
+        Returns the date of the Google translation of a field, even if a translation
+        made by a person is the one shown. If there are several, the date of the most
+        recent active one is returned.
+        """
         if not to_language:
             to_language = translation.get_language()
-        try:
-            return self.translations.get(field=field, language=to_language, from_google=True).created_at
-        except:
+        self.get_translation(field, to_language)
+        t = self.__dict__['_google_translation_objects'][(field, to_language)]
+        if t is None:
             return "No Translation Date"
+        return t.created_at
 
     def has_translation(self, field="text", to_language=None):
         if not to_language:
             to_language = translation.get_language()
-        translation_count = self.translations.filter(field=field, language=to_language).count()
-        if translation_count is 0:
-            return False
-        return True
+        looked_up = self.__dict__.get('_translation_objects', {})
+        if (field, to_language) in looked_up:
+            return looked_up[(field, to_language)] is not None
+        return self.translations.filter(field=field, language=to_language).exists()
+
+def forget_translations(object):
+    """
+    Drops the translations a TranslatedItem remembers (see TranslatedItem.translated and
+    get_translation). Called for the objects whose translations have just been written.
+    """
+    object.__dict__.pop('_translation_objects', None)
+    object.__dict__.pop('_google_translation_objects', None)
+    object.__dict__.pop('_translated_versions', None)
 
+# Fill in the language of TranslatedItems when they are saved (see autolex.autodetect).
+# TranslatedItem is abstract, so the handler receives every model's saves and checks the instance.
+pre_save.connect(detect_language_on_save)
+# Re-translate the fields of TranslatedItems that were edited (see autolex.retranslate).
+post_save.connect(retranslate_on_save)
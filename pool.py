@@ -0,0 +1,69 @@
+"""
+A small bounded thread pool, used to send requests to Google Translate in parallel.
+
+Use as follows:
+results = map_in_pool(function, items)
+
+The number of worker threads is limited by settings.GOOGLE_TRANSLATE_CONCURRENCY
+(4 by default). Only network calls should be made from the worker threads - keep
+database access on the calling thread.
+"""
+
+import sys
+import threading
+import Queue
+
+from django.conf import settings
+
+
+def get_concurrency():
+    """ Returns the maximum number of requests to send to Google Translate at once. """
+    return getattr(settings, 'GOOGLE_TRANSLATE_CONCURRENCY', 4)
+
+
+def map_in_pool(function, items, concurrency=None):
+    """
+    Calls function(item) for every item, using at most `concurrency` threads.
+
+    ** Output Parameters **
+    A list of the results, in the same order as items.
+
+    If any call raises an exception, no new calls are started and the first
+    exception is re-raised once the calls already running have finished.
+    """
+    items = list(items)
+    if concurrency is None:
+        concurrency = get_concurrency()
+
+    # Nothing to gain from threads - run in this thread.
+    if concurrency <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    tasks = Queue.Queue()
+    for task in enumerate(items):
+        tasks.put(task)
+
+    def worker():
+        while not errors:
+            try:
+                index, item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for i in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
@@ -0,0 +1,85 @@
+"""
+Re-translation of edited fields.
+
+Each Google translation records source_hash, a hash of the text it was translated
+from (see source_hash). When a TranslatedItem is saved, the Google translations of
+fields whose text no longer matches their hash are deactivated and queued for
+re-translation (see autolex.tasks.enqueue_translations). Translations made by
+people (from_google=False) are never touched, and neither are fields that did not
+change.
+
+Translations saved before source_hash existed have no hash, so their staleness is
+unknown and they are left alone. The column is added by syncdb for new databases;
+existing ones need:
+ALTER TABLE community_translation ADD COLUMN source_hash varchar(40) NULL;
+
+Settings:
+RETRANSLATE_ON_SAVE - look for stale translations when TranslatedItems are saved (default True)
+RETRANSLATE_IP_ADDRESS - the IP address queued jobs send Google (default '127.0.0.1')
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.utils.encoding import smart_str
+from django.contrib.contenttypes.models import ContentType
+
+
+def source_hash(text):
+    """ Returns the hash of the source text of a translation. """
+    return hashlib.sha1(smart_str(text or '')).hexdigest()
+
+
+def find_stale_translations(object):
+    """ Returns the active Google translations of an object whose source text has changed. """
+    from autolex.models import Translation
+    hashes = dict([(field, source_hash(object.__getattribute__(field))) for field in object.translated_fields])
+    if settings.COMMON_IDENTIFIER:
+        translations = Translation.active.filter(object_id=object.__getattribute__(settings.COMMON_IDENTIFIER))
+    else:
+        translations = Translation.active.filter(object_id=object.id,
+                                                 content_type=ContentType.objects.get_for_model(object))
+    translations = translations.filter(from_google=True, field__in=hashes.keys(), source_hash__isnull=False)
+    return [t for t in translations if t.source_hash != hashes[t.field]]
+
+
+def retranslate_stale_fields(object, ip_address=None):
+    """
+    Deactivates the stale Google translations of an object (see find_stale_translations)
+    and queues the fields for re-translation.
+
+    ** Output Parameters **
+    The translations that were deactivated.
+    """
+    from autolex.models import Translation, forget_translations
+    from autolex.cache import invalidate_translation
+    from autolex.tasks import enqueue_translations
+
+    stale = find_stale_translations(object)
+    if not stale:
+        return []
+
+    # A queryset update sends no signals, so invalidate the translation cache here.
+    Translation.objects.filter(id__in=[t.id for t in stale]).update(is_active=False)
+    for t in stale:
+        invalidate_translation(Translation, t)
+    forget_translations(object)
+
+    if ip_address is None:
+        ip_address = getattr(settings, 'RETRANSLATE_IP_ADDRESS', '127.0.0.1')
+    for language in set([t.language for t in stale]):
+        enqueue_translations([object], ip_address, language)
+    return stale
+
+
+def retranslate_on_save(sender, instance, created=False, raw=False, **kwargs):
+    """
+    post_save signal handler. Re-translates the edited fields of TranslatedItems, if
+    settings.RETRANSLATE_ON_SAVE is set.
+    """
+    if created or raw or not getattr(settings, 'RETRANSLATE_ON_SAVE', True):
+        return
+    from autolex.models import TranslatedItem
+    if not isinstance(instance, TranslatedItem):
+        return
+    retranslate_stale_fields(instance)
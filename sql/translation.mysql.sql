@@ -0,0 +1,3 @@
+-- Lookups by settings.COMMON_IDENTIFIER, which ignore the content type. MySQL has no
+-- partial indexes, so the index covers inactive translations too.
+CREATE INDEX translation_common_idx ON community_translation (object_id, language, field);
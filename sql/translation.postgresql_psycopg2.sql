@@ -0,0 +1,3 @@
+-- Lookups by settings.COMMON_IDENTIFIER, which ignore the content type. These only
+-- ever read active translations, so a partial index leaves out the inactive ones.
+CREATE INDEX translation_common_idx ON community_translation (object_id, language, field) WHERE is_active;
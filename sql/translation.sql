@@ -0,0 +1,9 @@
+-- Indexes for the translation lookups in utils.py. Django runs this file (and the
+-- file for the database backend in use, e.g. translation.postgresql_psycopg2.sql)
+-- after syncdb creates community_translation. To add the indexes to an existing
+-- database, run: python manage.py sqlcustom autolex | python manage.py dbshell
+
+-- Lookups by object: get_translated_version(s), find_missing_translations and the
+-- TranslatedItem.translations relation filter on object_id (often object_id IN (...)),
+-- content_type_id, language and field.
+CREATE INDEX translation_object_idx ON community_translation (object_id, content_type_id, language, field);
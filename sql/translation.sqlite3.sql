@@ -0,0 +1,4 @@
+-- Lookups by settings.COMMON_IDENTIFIER, which ignore the content type. SQLite cannot
+-- use a partial index for a query that passes is_active as a parameter, as Django does,
+-- so the index covers inactive translations too.
+CREATE INDEX translation_common_idx ON community_translation (object_id, language, field);
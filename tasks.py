@@ -0,0 +1,218 @@
+"""
+Background translation queue.
+
+Instead of contacting Google while rendering a page, views can call
+enqueue_translations, which records the missing fields as TranslationJob rows and
+returns immediately. Until the jobs have been processed, get_translated_version
+falls back on the original text.
+
+Jobs are processed by process_translation_jobs, either from the
+process_translations management command or from a TranslationWorker thread
+started inside the web process (start_translation_worker).
+
+Settings:
+TRANSLATE_IN_BACKGROUND - enqueue translations from views instead of fetching them inline (default False)
+TRANSLATION_JOB_MAX_ATTEMPTS - how many times a job is tried before it is dropped (default 3)
+TRANSLATION_JOB_TIMEOUT - seconds after which a claimed job is given to another worker (default 600)
+"""
+
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import translation
+from django.contrib.contenttypes.models import ContentType
+import ghdlog
+log = ghdlog.get_default_logger('apps.translate.tasks')
+
+from autolex.models import TranslationJob
+from autolex import utils
+
+
+def get_max_attempts():
+    return getattr(settings, 'TRANSLATION_JOB_MAX_ATTEMPTS', 3)
+
+def get_job_timeout():
+    return timedelta(seconds=getattr(settings, 'TRANSLATION_JOB_TIMEOUT', 600))
+
+
+def enqueue_translations(object_list, ip_address, to_language=None):
+    """
+    Queues the fields of object_list that do not have a translation yet.
+
+    ** Output parameters **
+    The number of new jobs. Fields that already have a pending job are skipped.
+    """
+    if not utils.is_valid_ip_address(ip_address):
+        return 0
+    if not to_language:
+        to_language = translation.get_language()
+
+    keys = []
+    for object, fields in utils.find_missing_translations(object_list, to_language):
+        content_type = ContentType.objects.get_for_model(object)
+        for field in fields:
+            keys.append((content_type.id, object.id, field))
+    if not keys:
+        return 0
+
+    # Do not queue a field twice.
+    pending = set(TranslationJob.objects.filter(object_id__in=set([key[1] for key in keys]),
+                                                language=to_language)
+                  .values_list('content_type', 'object_id', 'field'))
+    created = 0
+    for content_type_id, object_id, field in keys:
+        if (content_type_id, object_id, field) in pending:
+            continue
+        pending.add((content_type_id, object_id, field))
+        TranslationJob.objects.create(content_type_id=content_type_id, object_id=object_id, field=field,
+                                      language=to_language, ip_address=ip_address)
+        created += 1
+    return created
+
+
+def claim_translation_jobs(limit=100):
+    """
+    Claims up to `limit` of the oldest unclaimed jobs for this worker and returns them.
+    Jobs claimed by a worker that has not finished within TRANSLATION_JOB_TIMEOUT
+    can be claimed again.
+    """
+    now = datetime.now()
+    claimable = TranslationJob.objects.filter(Q(claimed_by=None) | Q(claimed_at__lt=now - get_job_timeout()))
+    ids = list(claimable.order_by('created_at').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+
+    # Another worker may claim some of the same jobs between the two queries;
+    # the update only succeeds for the jobs that are still claimable.
+    token = uuid.uuid4().hex
+    claimable.filter(id__in=ids).update(claimed_by=token, claimed_at=now)
+    return list(TranslationJob.objects.filter(claimed_by=token))
+
+
+def process_translation_jobs(limit=100):
+    """
+    Claims a batch of jobs, translates them and deletes the finished jobs.
+
+    ** Output parameters **
+    The number of jobs claimed. 0 means the queue is empty.
+
+    ** Algorithm **
+
+    - Claim a batch of jobs and drop duplicate jobs for the same field.
+    - Load the objects the jobs refer to, once per content type.
+    - Skip fields that have been translated since the job was queued.
+    - Translate the rest, grouped by language and IP address, with translate_missing_fields.
+    - Delete the finished jobs. Failed jobs are released to be tried again, up to
+      TRANSLATION_JOB_MAX_ATTEMPTS times.
+    """
+    jobs = claim_translation_jobs(limit)
+    if not jobs:
+        return 0
+
+    # Remove duplicate jobs
+    unique_jobs = {}
+    for job in jobs:
+        key = (job.content_type_id, job.object_id, job.field, job.language)
+        if key in unique_jobs:
+            job.delete()
+        else:
+            unique_jobs[key] = job
+
+    # Load the objects, once per content type.
+    objects = {}
+    ids_by_content_type = {}
+    for job in unique_jobs.values():
+        ids_by_content_type.setdefault(job.content_type_id, set()).add(job.object_id)
+    for content_type_id, ids in ids_by_content_type.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        for object_id, object in model._default_manager.in_bulk(list(ids)).items():
+            objects[(content_type_id, object_id)] = object
+
+    # Group the jobs by language and IP address, the parameters of each request to Google.
+    groups = {}
+    for (content_type_id, object_id, field, language), job in unique_jobs.items():
+        object = objects.get((content_type_id, object_id))
+        if object is None:
+            # The object has been deleted.
+            job.delete()
+            continue
+        groups.setdefault((language, job.ip_address), {}).setdefault(object, []).append(job)
+
+    for (language, ip_address), jobs_by_object in groups.items():
+        # Only translate the fields that are still missing.
+        missing = []
+        for object, fields in utils.find_missing_translations(jobs_by_object.keys(), language):
+            queued_fields = [job.field for job in jobs_by_object[object]]
+            fields = [field for field in fields if field in queued_fields]
+            if fields:
+                missing.append((object, fields))
+
+        failed = set([(object, field) for object, field in
+                      utils.translate_missing_fields(missing, language, ip_address)])
+
+        for object, object_jobs in jobs_by_object.items():
+            for job in object_jobs:
+                if (object, job.field) not in failed:
+                    job.delete()
+                elif not utils.google_translate_on():
+                    # Google Translate has been disabled - leave the job for later without counting an attempt.
+                    TranslationJob.objects.filter(id=job.id).update(claimed_by=None, claimed_at=None)
+                elif job.attempts + 1 >= get_max_attempts():
+                    log.error("Giving up on the %s translation of the %s field of object '%s'." \
+                                  % (language, job.field, object.__unicode__()))
+                    job.delete()
+                else:
+                    TranslationJob.objects.filter(id=job.id).update(claimed_by=None, claimed_at=None,
+                                                                    attempts=job.attempts + 1)
+
+    return len(jobs)
+
+
+def process_all_translation_jobs(limit=100):
+    """ Processes jobs until the queue is empty. Returns the number of jobs claimed. """
+    total = 0
+    while utils.google_translate_on():
+        claimed = process_translation_jobs(limit)
+        if not claimed:
+            break
+        total += claimed
+    return total
+
+
+class TranslationWorker(threading.Thread):
+    """
+    A thread that processes the translation queue inside the current process,
+    checking for new jobs every `interval` seconds once the queue is empty.
+    """
+
+    def __init__(self, interval=5, limit=100):
+        super(TranslationWorker, self).__init__()
+        self.setDaemon(True)
+        self.interval = interval
+        self.limit = limit
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.isSet():
+            try:
+                process_all_translation_jobs(self.limit)
+            except Exception, e:
+                log.error("Translation worker failed: %s" % e)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+TRANSLATION_WORKER = None
+
+def start_translation_worker(interval=5, limit=100):
+    """ Starts a TranslationWorker for this process, unless one is already running. """
+    global TRANSLATION_WORKER
+    if TRANSLATION_WORKER is None or not TRANSLATION_WORKER.isAlive():
+        TRANSLATION_WORKER = TranslationWorker(interval, limit)
+        TRANSLATION_WORKER.start()
+    return TRANSLATION_WORKER
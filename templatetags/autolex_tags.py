@@ -0,0 +1,50 @@
+"""
+Template tags for displaying translated objects.
+
+Use as follows:
+{% load autolex_tags %}
+{% prefetch_translations stories %}
+{% for story in stories %}
+    <h2>{{ story|translated:"title" }}</h2>
+{% endfor %}
+
+prefetch_translations looks up the translations of every object in the list at once
+(see autolex.utils.prefetch_translations), into the current language or the language
+given after the list: {% prefetch_translations stories "es" %}. Without it, the
+translated filter looks each field up separately.
+"""
+
+from django import template
+
+from autolex.utils import prefetch_translations
+
+register = template.Library()
+
+
+class PrefetchTranslationsNode(template.Node):
+
+    def __init__(self, object_list, language=None):
+        self.object_list = template.Variable(object_list)
+        self.language = language and template.Variable(language)
+
+    def render(self, context):
+        object_list = self.object_list.resolve(context)
+        language = None
+        if self.language:
+            language = self.language.resolve(context)
+        # Iterating a QuerySet fills its cache, so the template's own loop gets the same objects.
+        prefetch_translations(object_list, language)
+        return ''
+
+@register.tag(name='prefetch_translations')
+def do_prefetch_translations(parser, token):
+    bits = token.split_contents()
+    if len(bits) not in (2, 3):
+        raise template.TemplateSyntaxError("%r takes a list of objects and, optionally, a language" % bits[0])
+    return PrefetchTranslationsNode(*bits[1:])
+
+
+@register.filter
+def translated(object, field_name):
+    """ Returns the translated version of one of an object's fields. """
+    return object.translated(field_name)
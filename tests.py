@@ -1,19 +1,44 @@
 
 # coding: utf-8
 
+import os
 import re
+import shutil
+import tempfile
+import urllib
 import urllib2
+import threading
 import datetime
+import numpy as np
 
 from django.db import models
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.core.exceptions import MultipleObjectsReturned
 from django.test import TestCase
+from django.core.cache import get_cache
+from django.template import Template, Context
+from django.utils import translation
 from django.contrib.contenttypes.models import ContentType
-from autolex.models import Translation, TranslatedItem
-from autolex.detection import LangDetect
-from autolex.utils import make_translations, fetch_google_translation, break_into_chunks, communicate_with_google, get_translated_version, check_google_translate_errors
+from autolex.models import Translation, TranslatedItem, TranslationJob, TranslationClaim, LANGUAGE_CHOICES
+from autolex.detection import LangDetect, Postings, compile_model
+from autolex.autodetect import detect_languages, skip_language_detection
+from autolex.utils import make_translations, fetch_google_translation, break_into_chunks, communicate_with_google, get_translated_version
+from autolex.utils import get_translated_versions, translation_key, get_missing_fields, pack_segments, join_translated_chunks
+from autolex.utils import prefetch_translations
+from autolex.backfill import Backfill, Checkpoint, RateLimiter
+from autolex.utils import save_google_translation
+from autolex.retranslate import source_hash
+from autolex.pool import map_in_pool
+from autolex.cache import TranslationCache, SharedTranslationCache, TRANSLATION_CACHE, MISSING
+import autolex.cache as autolex_cache
+from autolex.backends import FakeTranslationBackend, GoogleTranslationBackend, TranslationBackendError, set_translation_backend
+from autolex.breaker import CircuitBreaker
+from autolex.benchmarks import StandInServer, StandInHandler, translation_indexes, mixed_entity_corpus
+from autolex.tasks import enqueue_translations, claim_translation_jobs
+from autolex.writer import TranslationWriter
+from autolex.flight import InFlight, claim_in_database, release_in_database
+from autolex.memory import MEMORY_STATS, memory_stats
 import autolex.utils as autolex_utils
 
 def suite():
@@ -68,6 +93,10 @@ class autolex_test(TestCase):
         # Patch needed settings
         self.old_common_identifier = settings.COMMON_IDENTIFIER
         settings.COMMON_IDENTIFIER = None
+        TRANSLATION_CACHE.clear()
+        # Start every test with a closed circuit breaker, whatever earlier tests recorded.
+        self.old_breaker = autolex_utils.GOOGLE_TRANSLATE_BREAKER
+        autolex_utils.GOOGLE_TRANSLATE_BREAKER = CircuitBreaker(enabled=settings.ENABLE_GOOGLE_TRANSLATE)
 
         self.user1 = User.objects.create_user('__test_user__', '')
         self.user1.first_name = '__test__'
@@ -124,6 +153,55 @@ class autolex_test(TestCase):
         self.assert_re_count(no_periods[0], '\.', 0)
         self.assert_re_count(no_periods[1],'\.', 2)
 
+    def test_break_into_chunks_encoded_length(self):
+        """
+        Tests that chunks are sized by their url-encoded length, join back into the
+        original string, and that very long strings do not hit the recursion limit.
+        """
+        text = "Caf\xc3\xa9 au lait, s'il vous pla\xc3\xaet! " * 20
+        chunks = break_into_chunks(text, length_of_chunk=100)
+        self.assertEqual(''.join(chunks), text)
+        for chunk in chunks:
+            self.assertTrue(len(urllib.quote_plus(chunk)) <= 100)
+            self.assertTrue(chunk.endswith("! "))
+            chunk.decode('utf-8')
+
+        # No chunks are left over from previous calls.
+        self.assertEqual(break_into_chunks("Short."), ["Short."])
+
+        long_text = "A sentence. " * 100000
+        chunks = break_into_chunks(long_text, length_of_chunk=100)
+        self.assertEqual(len(chunks), len(long_text) / 96)
+        self.assertEqual(''.join(chunks), long_text)
+
+        # A word boundary near the start of a chunk does not make a tiny chunk.
+        words = (" " + "a" * 4999) * 2
+        chunks = break_into_chunks(words)
+        self.assertEqual([len(chunk) for chunk in chunks], [5000, 5000])
+        self.assertEqual(''.join(chunks), words)
+
+    def test_join_translated_chunks(self):
+        """
+        Tests that join_translated_chunks restores line breaks and unescapes every kind
+        of character reference, whichever chunk it is in.
+        """
+        self.assertEqual(join_translated_chunks(["Tom &amp; Jerry said &quot;hi&quot;", " &#39;twice&#39; &lt;3"]),
+                         u"Tom & Jerry said \"hi\" 'twice' <3")
+        self.assertEqual(join_translated_chunks(["caf&eacute; &mdash; &#233; &#xE9; &#XE9;"]),
+                         u"caf\xe9 \u2014 \xe9 \xe9 \xe9")
+        self.assertEqual(join_translated_chunks(["one<br>two <BR> three<br/>", "four"]), u"one\ntwo \n three\nfour")
+        # Whitespace is collapsed and other tags are dropped, as they were by htmllib
+        self.assertEqual(join_translated_chunks(["  a \t b\n\nc ", " <b>d</b>  "]), u"a b c d")
+        # Text that only looks like markup is left alone
+        self.assertEqual(join_translated_chunks(["a < b > c &nosuchentity; AT&T &amp &#99999999999;"]),
+                         u"a < b > c &nosuchentity; AT&T &amp &#99999999999;")
+        # Google's response may be unicode or UTF-8
+        self.assertEqual(join_translated_chunks([u"\u4e2d &amp; ", "caf\xc3\xa9"]), u"\u4e2d & caf\xe9")
+
+        for seed in range(20):
+            chunks, text = mixed_entity_corpus(500, seed, words_per_chunk=7)
+            self.assertEqual(join_translated_chunks(chunks), text)
+
 
     ###################################################################
     ### Tests that begin with the fetch_google_translation function ###
@@ -167,45 +245,223 @@ class autolex_test(TestCase):
 
     def test_google_error_registry(self):
         """
-        Tests that fetch_google_translate returns immediately if there are too many
-        errors in the GOOGLE_TRANSLATE_ERRORS registry
+        Tests that the circuit breaker opens when there are too many recent errors,
+        and only remembers as many errors as it needs.
         """
-        if not settings.ENABLE_GOOGLE_TRANSLATE:
-            return
-
-        recent_error_entry = {'error' : 400, 'time' : datetime.datetime.now() }
-        older_error_entry = {'error' : 400, 'time' : datetime.datetime.now() - datetime.timedelta(minutes=55)}
-        oldest_error_entry = { 'error' : 400, 'time' : datetime.datetime.now() - datetime.timedelta(hours=23)}
+        now = [0]
+        clock = lambda: now[0]
 
         # too many errors in the last 5 minutes
-        self.assertEqual(autolex_utils.GOOGLE_TRANSLATE_ON, True)
-        autolex_utils.GOOGLE_TRANSLATE_ERRORS = [recent_error_entry] * 5
-        check_google_translate_errors()
-        self.assertEqual(autolex_utils.GOOGLE_TRANSLATE_ON, False)
+        breaker = CircuitBreaker(clock=clock)
+        for i in range(5):
+            self.assertEqual(breaker.is_available(), True)
+            breaker.record_failure(400)
+        self.assertEqual(breaker.is_available(), False)
 
         # too many errors in the last hour
-        autolex_utils.GOOGLE_TRANSLATE_ON = True
-        autolex_utils.GOOGLE_TRANSLATE_ERRORS = [older_error_entry] * 16
-        autolex_utils.GOOGLE_TRANSLATE_ERRORS.extend([recent_error_entry] * 4)
-        check_google_translate_errors()
-        self.assertEqual(autolex_utils.GOOGLE_TRANSLATE_ON, False)
+        breaker = CircuitBreaker(clock=clock)
+        for i in range(20):
+            now[0] = i * 170
+            breaker.record_failure(400)
+        self.assertEqual(breaker.is_available(), False)
 
         # too many errors in the last day
-        autolex_utils.GOOGLE_TRANSLATE_ON = True
-        autolex_utils.GOOGLE_TRANSLATE_ERRORS = [oldest_error_entry] * 31
-        autolex_utils.GOOGLE_TRANSLATE_ERRORS.extend([older_error_entry] * 15)
-        autolex_utils.GOOGLE_TRANSLATE_ERRORS.extend([recent_error_entry] * 4)
-        check_google_translate_errors()
-        self.assertEqual(autolex_utils.GOOGLE_TRANSLATE_ON, False)
+        breaker = CircuitBreaker(clock=clock)
+        for i in range(50):
+            now[0] = i * 1700
+            breaker.record_failure(400)
+        self.assertEqual(breaker.is_available(), False)
 
         # acceptable number of errors
-        autolex_utils.GOOGLE_TRANSLATE_ON = True
-        autolex_utils.GOOGLE_TRANSLATE_ERRORS = [oldest_error_entry] * 30
-        autolex_utils.GOOGLE_TRANSLATE_ERRORS.extend([older_error_entry] * 15)
-        autolex_utils.GOOGLE_TRANSLATE_ERRORS.extend([recent_error_entry] * 4)
-        check_google_translate_errors()
-        self.assertEqual(autolex_utils.GOOGLE_TRANSLATE_ON, True)
+        breaker = CircuitBreaker(clock=clock)
+        for i in range(500):
+            now[0] = i * 1800
+            breaker.record_failure(400)
+        self.assertEqual(breaker.is_available(), True)
+        self.assertEqual(len(breaker.failures), 50)
+
+        # turned off in settings.py
+        self.assertEqual(CircuitBreaker(enabled=False).allow_request(), False)
+
+    def test_circuit_breaker_probe(self):
+        """
+        Tests that an open circuit breaker lets a single probe through once its backoff
+        has passed, doubles the backoff when the probe fails and closes only when it succeeds.
+        """
+        now = [0]
+        breaker = CircuitBreaker(backoff=60, max_backoff=200, clock=lambda: now[0])
+        for i in range(5):
+            breaker.record_failure(400)
+        self.assertEqual(breaker.allow_request(), False)
+
+        now[0] = 60
+        self.assertEqual(breaker.allow_request(), True)
+        # only one probe at a time
+        self.assertEqual(breaker.allow_request(), False)
+        breaker.record_failure(400)
+        now[0] = 179
+        self.assertEqual(breaker.allow_request(), False)
+        now[0] = 180
+        self.assertEqual(breaker.allow_request(), True)
+        breaker.record_failure(400)
+        # the backoff stops growing at max_backoff
+        now[0] = 379
+        self.assertEqual(breaker.allow_request(), False)
+        now[0] = 380
+        self.assertEqual(breaker.allow_request(), True)
+
+        breaker.record_success()
+        self.assertEqual(breaker.allow_request(), True)
+        self.assertEqual(breaker.allow_request(), True)
+        self.assertEqual(breaker.backoff, 60)
+        self.assertEqual(len(breaker.failures), 0)
+        # finishing a request in the closed state changes nothing
+        breaker.finish_request()
+        self.assertEqual(breaker.allow_request(), True)
+
+        # a probe that ends without a result counts as a failure instead of blocking the breaker
+        for i in range(5):
+            breaker.record_failure(400)
+        now[0] = 440
+        self.assertEqual(breaker.allow_request(), True)
+        breaker.finish_request()
+        self.assertEqual(breaker.allow_request(), False)
+        now[0] = 560
+        self.assertEqual(breaker.allow_request(), True)
+
+        # a request sent before the breaker opened that succeeds afterwards does not close it
+        breaker = CircuitBreaker(backoff=60, clock=lambda: now[0])
+        for i in range(5):
+            breaker.record_failure(400)
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.allow_request(), False)
+
+    def test_shared_circuit_breaker(self):
+        """
+        Tests that a circuit breaker opened in one process stops the others that share its cache.
+        """
+        now = [0]
+        shared_cache = get_cache('locmem://')
+        breaker = CircuitBreaker(shared_cache=shared_cache, clock=lambda: now[0])
+        other_breaker = CircuitBreaker(shared_cache=shared_cache, clock=lambda: now[0])
+        for i in range(5):
+            breaker.record_failure(400)
+        self.assertEqual(other_breaker.allow_request(), False)
+
+        now[0] = 60
+        self.assertEqual(breaker.allow_request(), True)
+        breaker.record_success()
+        self.assertEqual(shared_cache.get(breaker.shared_key), None)
+
+
+    #####################################################
+    ### Tests that begin with the map_in_pool function ###
+    #####################################################
+    def test_map_in_pool(self):
+        """
+        Tests that map_in_pool keeps results in order and re-raises errors from the worker threads.
+        """
+        self.assertEqual(map_in_pool(lambda x: x * 2, range(50), concurrency=8), [x * 2 for x in range(50)])
+        self.assertEqual(map_in_pool(lambda x: x * 2, range(5), concurrency=1), [0, 2, 4, 6, 8])
+
+        def fail_on_seven(x):
+            if x == 7:
+                raise ValueError(x)
+            return x
+        self.assertRaises(ValueError, lambda: map_in_pool(fail_on_seven, range(20), concurrency=4))
 
+    def test_translate_chunks(self):
+        """
+        Tests that translate_chunks keeps each text's chunks in order and fails a whole
+        text if any one of its chunks fails.
+        """
+        class FailingBackend(FakeTranslationBackend):
+            def translate(self, texts, to_language, ip_address):
+                if "bad chunk" in texts:
+                    # Count the failed request too
+                    self.requests += 1
+                    raise TranslationBackendError("bad chunk")
+                return super(FailingBackend, self).translate(texts, to_language, ip_address)
+
+        backend = FailingBackend()
+        set_translation_backend(backend)
+        old_breaker = autolex_utils.GOOGLE_TRANSLATE_BREAKER
+        autolex_utils.GOOGLE_TRANSLATE_BREAKER = CircuitBreaker()
+        # Count every request (see test_translation_memory)
+        old_translation_memory = getattr(settings, 'TRANSLATION_MEMORY', True)
+        settings.TRANSLATION_MEMORY = False
+        try:
+            # short chunks from several texts share a request
+            jobs = [(self.object1, ["first", "second", "third"]), (self.object1, ["last"])]
+            results = autolex_utils.translate_chunks(jobs, 'es', self.test_ip)
+            self.assertEqual(results, [["[es] first", "[es] second", "[es] third"], ["[es] last"]])
+            self.assertEqual(backend.requests, 1)
+
+            backend.max_segments = 1
+            jobs = [(self.object1, ["first", "second", "third"]),
+                    (self.object1, ["fine chunk", "bad chunk"]),
+                    (self.object1, ["last"])]
+            results = autolex_utils.translate_chunks(jobs, 'es', self.test_ip)
+            self.assertEqual(results, [["[es] first", "[es] second", "[es] third"], None, ["[es] last"]])
+            self.assertEqual(backend.requests, 7)
+        finally:
+            set_translation_backend(None)
+            autolex_utils.GOOGLE_TRANSLATE_BREAKER = old_breaker
+            settings.TRANSLATION_MEMORY = old_translation_memory
+
+    def test_fake_translation_backend(self):
+        """
+        Tests that make_translations works offline with the fake backend, and that the
+        fake backend's errors are recorded by the circuit breaker.
+        """
+        Translation.objects.all().delete()
+        self.object1.text2 = "This is some more sample text."
+        self.object1.save()
+        set_translation_backend(FakeTranslationBackend())
+        old_breaker = autolex_utils.GOOGLE_TRANSLATE_BREAKER
+        autolex_utils.GOOGLE_TRANSLATE_BREAKER = CircuitBreaker()
+        try:
+            make_translations([self.object1], self.test_ip, to_language="es")
+            self.assertEqual(Translation.active.get(field='text2').translation, "[es] " + self.object1.text2)
+
+            set_translation_backend(FakeTranslationBackend(error_rate=1))
+            self.assertRaises(Exception, lambda: communicate_with_google(self.object1, "text", 'fr', self.test_ip))
+            self.assertEqual(len(autolex_utils.GOOGLE_TRANSLATE_BREAKER.failures), 1)
+        finally:
+            set_translation_backend(None)
+            autolex_utils.GOOGLE_TRANSLATE_BREAKER = old_breaker
+
+    def test_connection_pool(self):
+        """
+        Tests that the Google backend reuses kept-alive connections and reports errors as URLErrors.
+        """
+        server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            backend = GoogleTranslationBackend(url='http://127.0.0.1:%s/language/translate/v2' % server.server_address[1],
+                                               pool_size=2, timeout=5, gzip=False)
+            for i in range(5):
+                self.assertEqual(backend.translate(["Hello", "world"], 'es', self.test_ip), ["Hello", "world"])
+            self.assertEqual(backend.pool.connections_opened, 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        backend.pool.close()
+        self.assertRaises(urllib2.URLError, lambda: backend.translate(["Hello"], 'es', self.test_ip))
+
+    def test_pack_segments(self):
+        """
+        Tests that pack_segments respects both the character and the segment limits.
+        """
+        self.assertEqual(pack_segments(["a", "b", "c"], max_characters=100, max_segments=2), [[0, 1], [2]])
+        # each segment costs its url-encoded length plus 3 characters for "&q="
+        self.assertEqual(pack_segments(["aaaa", "bbbb", "c d"], max_characters=14, max_segments=10), [[0, 1], [2]])
+        self.assertEqual(pack_segments(["x" * 50, "y"], max_characters=10, max_segments=10), [[0], [1]])
+        self.assertEqual(pack_segments([]), [])
 
     ############################################################
     ### Tests that begin with the make_translations function ###
@@ -263,6 +519,20 @@ class autolex_test(TestCase):
         bad_object.save()
         self.assertRaises(AttributeError, lambda: make_translations([bad_object], self.test_ip, 'es'))
 
+    def test_get_missing_fields(self):
+        """
+        Tests that get_missing_fields only returns untranslated, non-empty fields of objects
+        that are not already written in the desired language.
+        """
+        object2 = TestTranslatedItem("This is a second English example.", 'en', "With a second field.")
+        object_es = TestTranslatedItem("El texto de este objecto era escrito en espanol", 'es')
+        type_id = self.testtranslateditem_type.id
+        keyed_objects = [(o, (type_id, o.id)) for o in [self.object1, object2, object_es]]
+        existing_translations = set([(type_id, self.object1.id, 'text1'), (type_id, object2.id, 'text2')])
+
+        missing = get_missing_fields(keyed_objects, existing_translations, 'es')
+        self.assertEqual(missing, [(object2, ['text1'])])
+
     def test_translate_empty_field(self):
         """
         Tests that using make_translations on an empty field does not create any translation objects.
@@ -339,6 +609,45 @@ class autolex_test(TestCase):
         self.assertEqual(Translation.objects.count(), 3)
         self.assertEqual(Translation.active.count(), 2)
 
+    ###############################################################
+    ### Tests that begin with the enqueue_translations function ###
+    ###############################################################
+    def test_enqueue_translations(self):
+        """
+        Tests that enqueue_translations queues each missing field once and does not contact Google.
+        """
+        self.object1.text2 = "This is some more sample text."
+        self.object1.save()
+        object_es = TestTranslatedItem("El texto de este objecto era escrito en espanol", 'es')
+        object_es.save()
+
+        # text1 is already translated and object_es is already in Spanish
+        self.assertEqual(enqueue_translations([self.object1, object_es], self.test_ip, 'es'), 1)
+        self.assertEqual(Translation.objects.count(), 1)
+        job = TranslationJob.objects.get()
+        self.assertEqual((job.object_id, job.field, job.language), (self.object1.id, 'text2', 'es'))
+
+        # the pending job is not duplicated, but other languages are queued separately
+        self.assertEqual(enqueue_translations([self.object1], self.test_ip, 'es'), 0)
+        self.assertEqual(enqueue_translations([self.object1], self.test_ip, 'fr'), 2)
+        self.assertEqual(enqueue_translations([self.object1], "bad.ip", 'de'), 0)
+        self.assertEqual(TranslationJob.objects.count(), 3)
+
+    def test_claim_translation_jobs(self):
+        """
+        Tests that a job can only be claimed by one worker until its claim times out.
+        """
+        self.object1.text2 = "This is some more sample text."
+        self.object1.save()
+        enqueue_translations([self.object1], self.test_ip, 'fr')
+
+        self.assertEqual(len(claim_translation_jobs(limit=1)), 1)
+        self.assertEqual(len(claim_translation_jobs()), 1)
+        self.assertEqual(claim_translation_jobs(), [])
+
+        TranslationJob.objects.update(claimed_at=datetime.datetime.now() - datetime.timedelta(hours=1))
+        self.assertEqual(len(claim_translation_jobs()), 2)
+
     #################################################################
     ### Tests that begin with the get_translated_version function ###
     #################################################################
@@ -352,6 +661,23 @@ class autolex_test(TestCase):
         translated_version = get_translated_version(self.object1, "text1", 'es')
         self.assertEqual(translated_version, self.object1_translation.translation)
 
+    def test_get_translated_version_common_identifier(self):
+        """
+        Tests that get_translated_version finds translations through the common identifier,
+        including when a field has more than one active translation.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        settings.COMMON_IDENTIFIER = 'id'
+        self.assertEqual(get_translated_version(self.object1, "text1", 'es'), self.object1_translation.translation)
+        TRANSLATION_CACHE.clear()
+        second_translation = Translation.objects.create(object_id=self.object1.id,
+                                                        content_type=self.testtranslateditem_type,
+                                                        field="text1", language='es',
+                                                        translation="spanish bar")
+        self.assertEqual(get_translated_version(self.object1, "text1", 'es'), second_translation.translation)
+
     def test_get_no_translation(self):
         """
         Tests that get_translated_version falls back on the original text if
@@ -411,6 +737,336 @@ class autolex_test(TestCase):
         settings.COMMON_IDENTIFIER = None
 
 
+    def test_translation_cache(self):
+        """
+        Tests that get_translated_version caches translations and misses, and that saving
+        or deactivating a translation invalidates the cache.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        self.assertEqual(get_translated_version(self.object1, "text1", 'es'), "spanish foo")
+        self.assertEqual(get_translated_version(self.object1, "text1", 'fr'), self.object1.text1)
+        self.assertEqual(TRANSLATION_CACHE.stats()['hits'], 0)
+        self.assertEqual(get_translated_version(self.object1, "text1", 'es'), "spanish foo")
+        self.assertEqual(get_translated_version(self.object1, "text1", 'fr'), self.object1.text1)
+        self.assertEqual(TRANSLATION_CACHE.stats()['hits'], 2)
+
+        # a new translation replaces a cached miss
+        Translation.objects.create(translation="french foo", language='fr', field='text1',
+                                   content_type=self.testtranslateditem_type, object_id=self.object1.id)
+        self.assertEqual(get_translated_version(self.object1, "text1", 'fr'), "french foo")
+
+        # a deactivated translation is no longer served
+        self.object1_translation.is_active = False
+        self.object1_translation.save()
+        self.assertEqual(get_translated_version(self.object1, "text1", 'es'), self.object1.text1)
+
+    def test_translation_cache_limits(self):
+        """
+        Tests that TranslationCache drops its least recently used and its expired entries.
+        """
+        cache = TranslationCache(max_size=2, ttl=300)
+        cache.set((1, 1, 'text1', 'es'), "one")
+        cache.set((1, 2, 'text1', 'es'), "two")
+        self.assertEqual(cache.get((1, 1, 'text1', 'es')), "one")
+        cache.set((1, 3, 'text1', 'es'), MISSING)
+        self.assertEqual(cache.get((1, 2, 'text1', 'es')), None)
+        self.assertEqual(cache.get((1, 3, 'text1', 'es')), MISSING)
+        self.assertEqual(cache.stats(), {'size' : 2, 'hits' : 2, 'misses' : 1})
+
+        cache.invalidate(1, 1)
+        self.assertEqual(cache.get((1, 1, 'text1', 'es')), None)
+
+        cache = TranslationCache(max_size=2, ttl=-1)
+        cache.set((1, 1, 'text1', 'es'), "one")
+        self.assertEqual(cache.get((1, 1, 'text1', 'es')), None)
+
+    def test_shared_translation_cache(self):
+        """
+        Tests that the shared cache stores translations and misses, and that invalidating
+        an object hides all of its cached translations.
+        """
+        shared_cache = SharedTranslationCache(get_cache('locmem://'))
+        shared_cache.set_many({(1, 1, 'text1', 'es') : "one", (1, 1, 'text2', 'es') : MISSING,
+                               (1, 2, 'text1', 'es') : "two"})
+        self.assertEqual(shared_cache.get_many([(1, 1, 'text1', 'es'), (1, 1, 'text2', 'es'), (1, 3, 'text1', 'es')]),
+                         {(1, 1, 'text1', 'es') : "one", (1, 1, 'text2', 'es') : MISSING})
+
+        shared_cache.invalidate(1, 1)
+        self.assertEqual(shared_cache.get_many([(1, 1, 'text1', 'es'), (1, 2, 'text1', 'es')]),
+                         {(1, 2, 'text1', 'es') : "two"})
+
+    def test_shared_translation_cache_lookups(self):
+        """
+        Tests that get_translated_version shares translations between processes through
+        the shared cache, and that saving a translation invalidates them.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        old_shared_cache = autolex_cache.SHARED_TRANSLATION_CACHE
+        autolex_cache.SHARED_TRANSLATION_CACHE = SharedTranslationCache(get_cache('locmem://'))
+        try:
+            self.assertEqual(get_translated_version(self.object1, "text1", 'es'), "spanish foo")
+
+            # Another process (simulated by clearing the process-local cache) finds the
+            # translation in the shared cache.
+            TRANSLATION_CACHE.clear()
+            Translation.objects.filter(id=self.object1_translation.id).update(translation="changed behind our back")
+            self.assertEqual(get_translated_version(self.object1, "text1", 'es'), "spanish foo")
+
+            self.object1_translation.translation = "spanish bar"
+            self.object1_translation.save()
+            TRANSLATION_CACHE.clear()
+            self.assertEqual(get_translated_version(self.object1, "text1", 'es'), "spanish bar")
+
+            # A save in another process (simulated by invalidating only the shared cache)
+            # hides the entry this process cached locally.
+            Translation.objects.filter(id=self.object1_translation.id).update(translation="spanish baz")
+            for object_key in ((self.object1_translation.content_type_id, self.object1_translation.object_id),
+                               (None, self.object1_translation.object_id)):
+                autolex_cache.SHARED_TRANSLATION_CACHE.invalidate(*object_key)
+            self.assertEqual(get_translated_version(self.object1, "text1", 'es'), "spanish baz")
+        finally:
+            autolex_cache.SHARED_TRANSLATION_CACHE = old_shared_cache
+
+    def test_translation_indexes(self):
+        """
+        Tests that the composite indexes in sql/ are picked up for the current database.
+        """
+        names = [name for name, statement in translation_indexes()]
+        self.assertTrue('translation_object_idx' in names)
+        self.assertTrue('translation_common_idx' in names)
+
+    def test_translation_writer(self):
+        """
+        Tests that TranslationWriter saves new translations with their timestamps and
+        translation set, skips fields that are already translated, and deactivates its
+        own translations when another process or a person wrote the same field.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        object2 = TestTranslatedItem("This is some more English example text.", 'en', "And some more.")
+        object2.save()
+        writer = TranslationWriter()
+        writer.add(self.object1, 'text1', 'es', "spanish bar", "set1") # already translated
+        writer.add(object2, 'text1', 'es', "spanish baz", "set2")
+        writer.add(object2, 'text2', 'es', "spanish qux", "set2")
+        writer.flush()
+        self.assertEqual(writer.pending, [])
+
+        self.assertEqual(get_translated_version(self.object1, "text1", 'es'), "spanish foo")
+        saved = Translation.active.filter(content_type=self.testtranslateditem_type, object_id=object2.id)
+        self.assertEqual(sorted([(t.field, t.translation, t.translation_set, t.from_google) for t in saved]),
+                         [('text1', "spanish baz", "set2", True), ('text2', "spanish qux", "set2", True)])
+        for t in saved:
+            self.assertTrue(t.created_at is not None and t.last_modified_at is not None)
+
+        # Another process translated object2's text1 at the same time, and a person text2:
+        # the most recent Google translation and the person's are kept, never deactivated.
+        Translation.objects.create(translation="spanish duplicate", language='es', field='text1', from_google=True,
+                                   content_type=self.testtranslateditem_type, object_id=object2.id)
+        Translation.objects.create(translation="spanish by hand", language='es', field='text2', from_google=False,
+                                   content_type=self.testtranslateditem_type, object_id=object2.id)
+        duplicates = writer.remove_duplicates(list(saved))
+        self.assertEqual(sorted([t.translation for t in duplicates]), ["spanish baz", "spanish qux"])
+        self.assertEqual(get_translated_version(object2, "text1", 'es'), "spanish duplicate")
+        self.assertEqual(get_translated_version(object2, "text2", 'es'), "spanish by hand")
+        self.assertEqual(writer.remove_duplicates(list(saved)), [])
+
+    def test_translation_writer_race(self):
+        """
+        Tests that two writers of the same field leave one active translation, when the
+        first has removed its duplicates before the second writes.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        object2 = TestTranslatedItem("This is some more English example text.", 'en', "And some more.")
+        object2.save()
+        writer_a = TranslationWriter()
+        writer_a.add(object2, 'text1', 'es', "spanish a", "set_a")
+        writer_b = TranslationWriter()
+        writer_b.add(object2, 'text1', 'es', "spanish b", "set_b")
+        # Writer B looked for existing translations before writer A committed.
+        writer_b.existing_keys = lambda translations: set()
+
+        writer_a.flush()
+        writer_b.flush()
+        active = Translation.active.filter(content_type=self.testtranslateditem_type, object_id=object2.id,
+                                           field='text1', language='es')
+        self.assertEqual([t.translation for t in active], ["spanish b"])
+
+    def test_in_flight(self):
+        """
+        Tests that only one thread at a time can claim a key, and that releasing it
+        wakes up the threads waiting for it.
+        """
+        in_flight = InFlight()
+        claimed, waiting = in_flight.claim(['a', 'b', 'a'])
+        self.assertEqual(claimed, ['a', 'b'])
+        self.assertEqual(waiting, {})
+
+        claimed, waiting = in_flight.claim(['b', 'c'])
+        self.assertEqual(claimed, ['c'])
+        self.assertEqual(waiting.keys(), ['b'])
+        self.assertFalse(waiting['b'].isSet())
+
+        in_flight.release(['b'])
+        self.assertTrue(waiting['b'].isSet())
+        self.assertEqual(in_flight.claim(['b'])[0], ['b'])
+
+    def test_claim_in_database(self):
+        """
+        Tests that a translation can only be claimed by one process at a time, and that
+        claims left behind by a dead process expire.
+        """
+        key = (self.testtranslateditem_type.id, self.object1.id, 'text2', 'es')
+        self.assertEqual(claim_in_database([key], 'first'), [key])
+        self.assertEqual(claim_in_database([key], 'second'), [])
+        release_in_database('first')
+        self.assertEqual(claim_in_database([key], 'second'), [key])
+
+        TranslationClaim.objects.filter(claimed_by='second').update(claimed_at=datetime.datetime(2000, 1, 1))
+        self.assertEqual(claim_in_database([key], 'third'), [key])
+
+    def test_translate_missing_fields_single_flight(self):
+        """
+        Tests that translate_missing_fields skips fields another process is fetching,
+        without counting them as failed.
+        """
+        object2 = TestTranslatedItem("This is some more English example text.", 'en', "And some more.")
+        object2.save()
+        backend = FakeTranslationBackend()
+        set_translation_backend(backend)
+        old_breaker = autolex_utils.GOOGLE_TRANSLATE_BREAKER
+        autolex_utils.GOOGLE_TRANSLATE_BREAKER = CircuitBreaker()
+        try:
+            claim_in_database([autolex_utils.cache_key(object2, 'text1', 'es')], 'another process')
+            failed = autolex_utils.translate_missing_fields([(object2, ['text1', 'text2'])], 'es', self.test_ip)
+            self.assertEqual(failed, [])
+            self.assertEqual(get_translated_version(object2, 'text1', 'es'), object2.text1)
+            self.assertEqual(get_translated_version(object2, 'text2', 'es'), "[es] And some more.")
+
+            # Our claims were released.
+            self.assertEqual(TranslationClaim.objects.exclude(claimed_by='another process').count(), 0)
+        finally:
+            set_translation_backend(None)
+            autolex_utils.GOOGLE_TRANSLATE_BREAKER = old_breaker
+
+    def test_translation_memory(self):
+        """
+        Tests that translate_chunks only sends Google one copy of each chunk, and reuses
+        remembered translations of chunks for other objects.
+        """
+        object2 = TestTranslatedItem("This is some more English example text.", 'en')
+        object2.save()
+        backend = FakeTranslationBackend(max_segments=1)
+        set_translation_backend(backend)
+        old_breaker = autolex_utils.GOOGLE_TRANSLATE_BREAKER
+        autolex_utils.GOOGLE_TRANSLATE_BREAKER = CircuitBreaker()
+        MEMORY_STATS.clear()
+        try:
+            jobs = [(self.object1, ["Signature.", "First paragraph."]), (object2, ["Signature."])]
+            results = autolex_utils.translate_chunks(jobs, 'es', self.test_ip)
+            self.assertEqual(results, [["[es] Signature.", "[es] First paragraph."], ["[es] Signature."]])
+            self.assertEqual(backend.requests, 2)
+
+            jobs = [(object2, ["First paragraph.", "Second paragraph."])]
+            results = autolex_utils.translate_chunks(jobs, 'es', self.test_ip)
+            self.assertEqual(results, [["[es] First paragraph.", "[es] Second paragraph."]])
+            self.assertEqual(backend.requests, 3)
+
+            # Remembered translations are kept per pair of languages.
+            results = autolex_utils.translate_chunks(jobs, 'fr', self.test_ip)
+            self.assertEqual(backend.requests, 5)
+
+            self.assertEqual(memory_stats(), {'hits' : 1, 'misses' : 5, 'hit_rate' : 1.0 / 6})
+        finally:
+            set_translation_backend(None)
+            autolex_utils.GOOGLE_TRANSLATE_BREAKER = old_breaker
+
+    def test_backfill(self):
+        """
+        Tests that a backfill finds the non-empty fields without an active translation,
+        keeps to its rate budget and resumes from its checkpoint.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        object2 = TestTranslatedItem("This is a second English example.", 'en', "With a second field.")
+        object2.save()
+        object_es = TestTranslatedItem("El texto de este objecto era escrito en espanol", 'es', "Y otro campo.")
+        object_es.save()
+        backfill = Backfill('es', self.test_ip, models=[TestTranslatedItem])
+        missing = backfill.find_missing(TestTranslatedItem, [self.object1, object2, object_es])
+        self.assertEqual(missing, [(object2, ['text1', 'text2'])])
+
+        now = [0.0]
+        sleeps = []
+        limiter = RateLimiter(100, clock=lambda: now[0], sleep=sleeps.append)
+        limiter.spend(100)
+        limiter.spend(50)
+        now[0] = 1.0
+        limiter.spend(150)
+        self.assertEqual(sleeps, [0.5, 1.0])
+
+        checkpoint_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(checkpoint_dir, 'backfill_es.json')
+            checkpoint = Checkpoint(path, 'es')
+            checkpoint.after['autolex.TestTranslatedItem'] = object2.id
+            checkpoint.save()
+            self.assertEqual(Checkpoint(path, 'es').after, {'autolex.TestTranslatedItem' : object2.id})
+            self.assertRaises(ValueError, lambda: Checkpoint(path, 'fr'))
+            backfill = Backfill('es', self.test_ip, models=[TestTranslatedItem], checkpoint_path=path)
+            self.assertEqual(backfill.remaining(TestTranslatedItem), 1)
+
+            # The breaker opens partway through a page: the checkpoint stays before it.
+            class OnePageBackfill(Backfill):
+                def iter_pages(backfill, model):
+                    yield [self.object1, object2]
+            old_breaker = autolex_utils.GOOGLE_TRANSLATE_BREAKER
+            autolex_utils.GOOGLE_TRANSLATE_BREAKER = CircuitBreaker(thresholds=((1, 60),))
+            set_translation_backend(FakeTranslationBackend(error_rate=1))
+            try:
+                path = os.path.join(checkpoint_dir, 'backfill_es_2.json')
+                backfill = OnePageBackfill('es', self.test_ip, models=[TestTranslatedItem], checkpoint_path=path)
+                self.assertEqual(backfill.run(), False)
+                self.assertEqual(backfill.fields_failed, 2)
+                self.assertEqual(Checkpoint(path, 'es').after, {})
+            finally:
+                set_translation_backend(None)
+                autolex_utils.GOOGLE_TRANSLATE_BREAKER = old_breaker
+        finally:
+            shutil.rmtree(checkpoint_dir)
+
+    def test_retranslate_edited_fields(self):
+        """
+        Tests that saving an edited item deactivates and re-queues only the Google
+        translations of the fields that changed, and keeps translations made by people.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        self.object1.text2 = "A second field."
+        self.object1.save()
+        french_text1 = save_google_translation(self.object1, 'text1', 'fr', "french foo")
+        french_text2 = save_google_translation(self.object1, 'text2', 'fr', "french bar")
+        self.assertEqual(french_text1.source_hash, source_hash(self.object1.text1))
+
+        # saving without changes queues nothing
+        self.object1.save()
+        self.assertEqual(TranslationJob.objects.count(), 0)
+
+        self.object1.text1 = "This is some edited English example text."
+        self.object1.save()
+        active = Translation.active.filter(object_id=self.object1.id)
+        self.assertEqual(set(active.values_list('id', flat=True)), set([self.object1_translation.id, french_text2.id]))
+        self.assertEqual(list(TranslationJob.objects.values_list('field', 'language')), [('text1', 'fr')])
+
     def test_get_bad_field(self):
         """
         Tests that using get_translated_version with a non-translated field raises an error.
@@ -420,6 +1076,153 @@ class autolex_test(TestCase):
 
         self.assertRaises(ValueError, lambda: get_translated_version(self.object1, "untranslated_field", 'es'))
 
+    ##################################################################
+    ### Tests that begin with the get_translated_versions function ###
+    ##################################################################
+    def test_get_translated_versions(self):
+        """
+        Tests that get_translated_versions retrieves translations for several objects at once,
+        falling back on the original text where there is no translation.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        object2 = TestTranslatedItem("This is a second English example.", 'en', "With a second field.")
+        object2.save()
+        object2_translation = Translation.objects.create(translation="spanish baz", language='es', field='text2',
+                                                         content_type=self.testtranslateditem_type, object_id=object2.id)
+        object_es = TestTranslatedItem("El texto de este objecto era escrito en espanol", 'es')
+        object_es.save()
+
+        versions = get_translated_versions([self.object1, object2, object_es], to_language='es')
+        self.assertEqual(len(versions), 6)
+        self.assertEqual(versions[translation_key(self.object1, 'text1')], self.object1_translation.translation)
+        self.assertEqual(versions[translation_key(self.object1, 'text2')], self.object1.text2)
+        self.assertEqual(versions[translation_key(object2, 'text1')], object2.text1)
+        self.assertEqual(versions[translation_key(object2, 'text2')], object2_translation.translation)
+        self.assertEqual(versions[translation_key(object_es, 'text1')], object_es.text1)
+
+        # only the requested fields are looked up
+        versions = get_translated_versions([self.object1, object2], ['text1'], 'es')
+        self.assertEqual(len(versions), 2)
+        self.assertRaises(ValueError, lambda: get_translated_versions([self.object1], ['untranslated_field'], 'es'))
+
+    def test_get_translated_versions_matches_single_lookup(self):
+        """
+        Tests that get_translated_versions agrees with get_translated_version, including the
+        most-recent-wins rule and the common identifier.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        second_translation = Translation.objects.create(object_id=self.object1.id,
+                                                        content_type=self.testtranslateditem_type,
+                                                        field="text1", language='es',
+                                                        translation="spanish bar")
+        for common_identifier in (None, 'id'):
+            settings.COMMON_IDENTIFIER = common_identifier
+            versions = get_translated_versions([self.object1], to_language='es')
+            for field in self.object1.translated_fields:
+                self.assertEqual(versions[translation_key(self.object1, field)],
+                                 get_translated_version(self.object1, field, 'es'))
+            self.assertEqual(versions[translation_key(self.object1, 'text1')], second_translation.translation)
+        settings.COMMON_IDENTIFIER = None
+
+    def test_prefetch_translations(self):
+        """
+        Tests that prefetch_translations and the prefetch_translations template tag attach
+        translations to objects, so that translated() does not query the database again.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        object2 = TestTranslatedItem("This is a second English example.", 'en', "With a second field.")
+        object2.save()
+        Translation.objects.create(translation="spanish baz", language='es', field='text1',
+                                   content_type=self.testtranslateditem_type, object_id=object2.id)
+        prefetch_translations([self.object1, object2], 'es')
+
+        # Nothing is left to find the translations in but the objects themselves.
+        Translation.objects.all().delete()
+        TRANSLATION_CACHE.clear()
+        self.assertEqual(self.object1.translated('text1', 'es'), "spanish foo")
+        self.assertEqual(self.object1.translated('text2', 'es'), self.object1.text2)
+        self.assertEqual(object2.translated('text1', 'es'), "spanish baz")
+        self.assertEqual(object2.translated('text1', 'en'), object2.text1)
+
+        object3 = TestTranslatedItem("A third English example.", 'en')
+        object3.save()
+        Translation.objects.create(translation="spanish qux", language='es', field='text1',
+                                   content_type=self.testtranslateditem_type, object_id=object3.id)
+        template = Template('{% load autolex_tags %}{% prefetch_translations objects "es" %}'
+                            '{% for object in objects %}{{ object|translated:"text1" }}|{% endfor %}')
+        objects = [object3]
+        translation.activate('es')
+        try:
+            self.assertEqual(template.render(Context({'objects' : objects})), "spanish qux|")
+        finally:
+            translation.deactivate()
+        self.assertEqual(object3._translated_versions[('text1', 'es')], "spanish qux")
+
+        # with_translations survives further filtering
+        queryset = TestTranslatedItem.objects.with_translations('es').filter(language='en')
+        self.assertEqual((queryset.prefetching, queryset.prefetch_language), (True, 'es'))
+
+    def test_translation_helpers(self):
+        """
+        Tests that the TranslatedItem helpers look up the translations of all of an
+        object's fields once and answer later calls from memory.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        google_translation = Translation.objects.create(translation="spanish google", language='es', field='text2',
+                                                        from_google=True, content_type=self.testtranslateditem_type,
+                                                        object_id=self.object1.id)
+        # an older Google translation of a field a person has since translated
+        old_google_translation = Translation.objects.create(translation="old spanish google", language='es',
+                                                            field='text1', from_google=True, is_active=False,
+                                                            content_type=self.testtranslateditem_type,
+                                                            object_id=self.object1.id)
+        self.assertEqual(self.object1.has_translation('text1', 'es'), True)
+        self.assertEqual(self.object1.has_translation('text1', 'fr'), False)
+        self.assertEqual(self.object1.translated_by_google('text1', 'es'), False)
+
+        Translation.objects.all().delete()
+        self.assertEqual(self.object1.translated_by_google('text2', 'es'), True)
+        self.assertEqual(self.object1.google_translation_date('text2', 'es'), google_translation.created_at)
+        self.assertEqual(self.object1.google_translation_date('text1', 'es'), old_google_translation.created_at)
+        self.assertEqual(self.object1.google_translation_date('text1', 'fr'), "No Translation Date")
+        self.assertEqual(self.object1.has_translation('text2', 'es'), True)
+        self.assertEqual(self.object1.get_translation('text1', 'es').translation, "spanish foo")
+        self.assertRaises(Translation.DoesNotExist, lambda: self.object1.translated_by_google('text1', 'fr'))
+
+    def test_translation_helpers_after_writes(self):
+        """
+        Tests that an object forgets the translations it remembers once new ones are
+        saved for it.
+        """
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        object2 = TestTranslatedItem("This is some more English example text.", 'en', "And some more.")
+        object2.save()
+        self.assertEqual(object2.get_translation('text1', 'es'), None)
+        self.assertEqual(object2.has_translation('text1', 'es'), False)
+        self.assertEqual(object2.translated('text1', 'es'), object2.text1)
+
+        save_google_translation(object2, 'text1', 'es', "spanish baz")
+        self.assertEqual(object2.has_translation('text1', 'es'), True)
+        self.assertEqual(object2.translated('text1', 'es'), "spanish baz")
+
+        writer = TranslationWriter()
+        writer.add(object2, 'text2', 'es', "spanish qux")
+        self.assertEqual(object2.get_translation('text2', 'es'), None)
+        self.assertEqual(object2.translated('text2', 'es'), object2.text2)
+        writer.flush()
+        self.assertEqual(object2.has_translation('text2', 'es'), True)
+        self.assertEqual(object2.translated('text2', 'es'), "spanish qux")
+
     def test_detection(self):
         """
         Tests that autolex.detection correctly detects a string's language.
@@ -443,5 +1246,144 @@ class autolex_test(TestCase):
         self.assertEqual(ld.detect(text_es), "es")
         self.assertEqual(ld.detect(text_ru), "ru")
 
+        # Django model fields are unicode
+        unicode_ru = u"\u0411\u044b\u0441\u0442\u0440\u0430\u044f \u043a\u043e\u0440\u0438\u0447\u043d\u0435\u0432\u0430\u044f \u043b\u0438\u0441\u0430 \u043f\u0440\u044b\u0433\u0430\u0435\u0442 \u0447\u0435\u0440\u0435\u0437 \u043b\u0435\u043d\u0438\u0432\u0443\u044e \u0441\u043e\u0431\u0430\u043a\u0443"
+        self.assertEqual(ld.detect(unicode_ru), "ru")
+        self.assertEqual(ld.detect(unicode_ru.encode('utf-8')), "ru")
+        self.assertTrue(ld.analyze(unicode_ru).confidence > 0.5)
+
+    def test_compiled_detection_model(self):
+        """
+        Tests that LangDetect gives the same results with a compiled model as with the corpus.
+        """
+
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        texts = ["De snelle bruine vos springt over de luie hond",
+                 "The quick brown fox jumps over the lazy dog",
+                 "Le renard brun rapide saute par-dessus le chien paresseux",
+                 "El perro perezoso duerme"]
+        model_path = tempfile.mkdtemp()
+        try:
+            compile_model(model_path, ['nl', 'en', 'fr', 'es'])
+            from_corpus = LangDetect(['nl', 'en', 'fr', 'es'], model_path=os.path.join(model_path, 'missing'))
+            from_model = LangDetect(['es', 'en', 'fr', 'nl'], model_path=model_path)
+            self.assertEqual([from_model.detect(text) for text in texts], [from_corpus.detect(text) for text in texts])
+            self.assertEqual(from_model.detect(texts[0]), "nl")
+        finally:
+            shutil.rmtree(model_path)
+
+    def test_detect_many(self):
+        """
+        Tests that detect_many agrees with detect and reports a confidence for each text.
+        """
+
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        texts = ["De snelle bruine vos springt over de luie hond",
+                 "The quick brown fox jumps over the lazy dog",
+                 "Le renard brun rapide saute par-dessus le chien paresseux",
+                 ""]
+        ld = LangDetect()
+        results = ld.detect_many(texts, batch_size=3)
+        self.assertEqual([language for language, confidence in results[:3]], ["nl", "en", "fr"])
+        self.assertEqual([language for language, confidence in results], [ld.detect(text) for text in texts])
+        for language, confidence in results[:3]:
+            self.assertTrue(0 < confidence <= 1)
+        # Nothing to go on
+        self.assertEqual(results[3][1], 0.0)
+
+    def test_detection_result(self):
+        """
+        Tests that LangDetect.analyze ranks the languages with normalized scores, and
+        stops reading a long text once the margin is large enough.
+        """
+
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        ld = LangDetect()
+        text = "The quick brown fox jumps over the lazy dog. " * 200
+        result = ld.analyze(text)
+        self.assertEqual(result.language, "en")
+        self.assertEqual(len(result.ranked), 6)
+        self.assertAlmostEqual(sum([score for language, score in result.ranked]), 1.0)
+        self.assertEqual(result.top(1), [(result.language, result.confidence)])
+        self.assertAlmostEqual(result.margin, result.ranked[0][1] - result.ranked[1][1])
+        self.assertEqual(result.characters_read, len(text))
+
+        early = ld.analyze(text, margin=0.01, block_size=100)
+        self.assertEqual(early.language, "en")
+        self.assertTrue(early.margin >= 0.01)
+        self.assertTrue(early.characters_read < len(text))
+
+    def test_postings(self):
+        """
+        Tests that Postings returns the languages and weights of each trigram.
+        """
+        # trigram 0 occurs in languages 0 and 2, trigram 1 in none, trigram 2 in language 1
+        postings = Postings.from_entries(3, [2, 0, 0], [1, 2, 0], [0.5, 0.25, 0.125])
+        self.assertEqual(list(postings.indptr), [0, 2, 2, 3])
+        positions, languages, weights = postings.gather(np.array([2, 1, 0]))
+        self.assertEqual(list(positions), [0, 2, 2])
+        self.assertEqual(list(languages), [1, 2, 0])
+        self.assertEqual(list(weights), [0.5, 0.25, 0.125])
+
+    def test_detect_all_languages(self):
+        """
+        Tests that LangDetect can detect every language of LANGUAGE_CHOICES in the corpus.
+        """
+
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        ld = LangDetect(languages=None)
+        codes = [code for code, name in LANGUAGE_CHOICES]
+        for language in ld.languages:
+            self.assertTrue(language in codes)
+        for language in ['nl', 'en', 'fr', 'de', 'es', 'ru']:
+            self.assertTrue(language in ld.languages)
+        self.assertEqual(ld.detect("The quick brown fox jumps over the lazy dog"), "en")
+
+    def test_detect_language_on_save(self):
+        """
+        Tests that saving a TranslatedItem of unknown language fills in its language,
+        unless detection is skipped.
+        """
+
+        if not settings.ENABLE_TRANSLATIONS:
+            return
+
+        old_detect_language_on_save = getattr(settings, 'DETECT_LANGUAGE_ON_SAVE', False)
+        settings.DETECT_LANGUAGE_ON_SAVE = True
+        try:
+            object2 = TestTranslatedItem("The quick brown fox jumps over the lazy dog", '')
+            object2.save()
+            self.assertEqual(object2.language, 'en')
+
+            # Languages that are already set are kept.
+            object3 = TestTranslatedItem("The quick brown fox jumps over the lazy dog", 'fr')
+            object3.save()
+            self.assertEqual(object3.language, 'fr')
+
+            object4 = TestTranslatedItem("The quick brown fox jumps over the lazy dog", '')
+            object4.skip_language_detection = True
+            object4.save()
+            self.assertEqual(object4.language, '')
+
+            object5 = TestTranslatedItem("The quick brown fox jumps over the lazy dog", '')
+            with skip_language_detection():
+                object5.save()
+            self.assertEqual(object5.language, '')
+
+            # Fill in the skipped languages in one batch.
+            self.assertEqual(detect_languages([object3, object4, object5], save=True), [object4, object5])
+            self.assertEqual(TestTranslatedItem.objects.filter(id=object5.id).values_list('language', flat=True)[0], 'en')
+        finally:
+            settings.DETECT_LANGUAGE_ON_SAVE = old_detect_language_on_save
+
     def tearDown(self):
         settings.COMMON_IDENTIFIER = self.old_common_identifier
+        autolex_utils.GOOGLE_TRANSLATE_BREAKER = self.old_breaker
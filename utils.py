@@ -1,13 +1,24 @@
+import re
 import socket
-import htmllib
+import string
+import htmlentitydefs
 from datetime import timedelta
 
 from django.utils import translation
 from django.core.exceptions import MultipleObjectsReturned
 from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import smart_unicode
 import ghdlog
 log = ghdlog.get_default_logger('apps.translate.utils')
 from autolex.models import *
+from autolex.pool import map_in_pool
+from autolex.backends import get_translation_backend
+from autolex.cache import get_cached_translations, cache_translations, MISSING
+from autolex.writer import TranslationWriter
+from autolex.flight import Flight
+from autolex.memory import memory_enabled, memory_key, recall_translations, remember_translations
+from autolex.breaker import get_google_translate_breaker
+from autolex.retranslate import source_hash
 
 """
 def make_translation(object, ip_address):
@@ -64,7 +75,7 @@ def make_translations(object_list, ip_address, to_language=None):
     ip_address: the current user's IP address. Needed to contact Google.
 
     ** Modifications **
-    Adds new translation objects to the database through fetch_google_translation.
+    Adds new translation objects to the database through translate_missing_fields.
 
     ** Output parameters **
     None
@@ -73,272 +84,536 @@ def make_translations(object_list, ip_address, to_language=None):
 
     - Query the database to see if there are pre-existing translations for any of the objects.
     - Determine which objects do not already have translations.
-    - Get and save Google translations for those objects using fetch_google_translation.
+    - Get and save Google translations for those objects using translate_missing_fields.
 
     """
 
     # Check that ip address is valid. If not, return without further processing.
+    if not is_valid_ip_address(ip_address):
+        return
+    # Determine which language to translate into
+    if not to_language:
+        to_language = translation.get_language()
+
+    translate_missing_fields(find_missing_translations(object_list, to_language), to_language, ip_address)
+    return
+
+
+def is_valid_ip_address(ip_address):
+    """ Returns True if ip_address is a valid IPv4 or IPv6 address. Google needs one with every request. """
     try:
         socket.inet_pton(socket.AF_INET, ip_address)
     except socket.error:
         try:
             socket.inet_pton(socket.AF_INET6, ip_address)
         except socket.error:
-            return
-    # Determine which language to translate into
-    if not to_language:
-        to_language = translation.get_language()
+            return False
+    return True
 
-    # existing_translations will hold all relevant translations already in the database.
-    existing_translations = []
 
-    # Get pre-existing translations using a common identifier for differentiating
-    # between translated items.
-    if settings.COMMON_IDENTIFIER:
-        ids_list = []
-        for obj in object_list:
-            ids_list.append(obj.__getattribute__(settings.COMMON_IDENTIFIER))
-        existing_translations = Translation.active.filter(object_id__in=ids_list, language=to_language)
+def find_missing_translations(object_list, to_language):
+    """
+    Queries the database for the existing translations of a list of objects and
+    returns the fields that still need a translation, in the form
+    [ (object, ['field1', 'field2']) ] (see get_missing_fields).
+    """
 
-        # Determine which translations are missing and fetch them if necessary.
-        for object in object_list:
-            if object.language != to_language:
-                translation_set = uuid.uuid4()
-                for field in object.translated_fields:
-                    translation_for_this_field = filter(lambda x: x.object_id == object.node_ptr_id and
-                                                        x.field == field,
-                                                        existing_translations)
-                    if translation_for_this_field == []:
-                    # do not get a translation if this field is empty
-                        if object.__getattribute__(field) is not '':
-                            fetch_google_translation(object, field, to_language, ip_address, translation_set)
-        return
+    # Index the objects by the key their translations are stored under:
+    # (content type id, object id) normally, or (None, common identifier) when
+    # translations are shared between content types through a common identifier.
+    keyed_objects = []
+    content_type_ids = {}
+    for object in object_list:
+        if settings.COMMON_IDENTIFIER:
+            keyed_objects.append((object, (None, object.__getattribute__(settings.COMMON_IDENTIFIER))))
+        else:
+            if object.__class__ not in content_type_ids:
+                content_type_ids[object.__class__] = ContentType.objects.get_for_model(object).id
+            keyed_objects.append((object, (content_type_ids[object.__class__], object.id)))
+
+    # The items dictionary is used to sort the object ids by content type.
+    # items will look like { <Content Type id 1> : [1, 2, 3], <Content Type id 2> : [4, 5, 6] }
+    items = {}
+    for object, (content_type_id, object_id) in keyed_objects:
+        items.setdefault(content_type_id, []).append(object_id)
+
+    # existing_translations will hold the (content type id, object id, field) keys of all
+    # relevant translations already in the database. Query the database once for each
+    # content type, or once in total when using a common identifier.
+    existing_translations = set()
+    for content_type_id, ids_list in items.items():
+        if content_type_id is None:
+            rows = Translation.active.filter(object_id__in=ids_list, language=to_language)
+        else:
+            rows = Translation.active.filter(object_id__in=ids_list, content_type=content_type_id,
+                                             language=to_language)
+        for object_id, field in rows.values_list('object_id', 'field'):
+            existing_translations.add((content_type_id, object_id, field))
 
-    else:
-        # Get pre-existing translations using Django's content type framework
-        # for differentiating between translated items
-
-        # The items dictionary is used to sort the object list by content type.
-        # items will look like { <Content Type 1> : 1, 2, 3 ; <Content Type 2> : 4, 5, 6 }
-        # where the numbers are the object ids associated with a given content type.
-        items = {}
-
-        # Populate the items dictionary as described above:
-        # Add all of the content types represented by objects in object_list
-        # as keys to the items dictionary, and all of the object ids as values.
-        for object in object_list:
-            objects_content_type = ContentType.objects.get_for_model(object)
-            if objects_content_type not in items.keys():
-                items[objects_content_type] = []
-            items[objects_content_type].append(object.id)
-
-        # Get a list of translations connected to the objects in list
-        # by querying the database once for each content type.
-        for content_type in items.keys():
-            existing_translations.extend(Translation.active.filter(object_id__in=items[content_type],
-                                                                    content_type=content_type,
-                                                                    language=to_language))
-
-        # Create translations for objects that do not have them yet,
-        # field by field.
-        for object in object_list:
-            if object.language != to_language:
-                translation_set = uuid.uuid4()
-                for field in object.translated_fields:
-                    content_type = ContentType.objects.get_for_model(object)
-                    translation_for_this_field = filter(lambda x: x.content_type == content_type and
-                                                        x.object_id == object.id and
-                                                        x.field == field,
-                                                        existing_translations)
-                    if translation_for_this_field == []:
-                        if object.__getattribute__(field) is not '':
-                            fetch_google_translation(object, field, to_language, ip_address, translation_set)
+    return get_missing_fields(keyed_objects, existing_translations, to_language)
 
-    return
 
+def translate_missing_fields(missing, to_language, ip_address):
+    """
+    Gets and saves Google translations for the fields returned by find_missing_translations.
+
+    The chunks of every missing field are sent to Google in parallel (see translate_chunks),
+    and the translations are then saved from this thread in one transaction (see
+    autolex.writer). Fields of the same object share a translation set.
 
-GOOGLE_TRANSLATE_ERRORS = [] # a list of errors in the form [{ 'error' : code, 'time' : datetime object}]
-GOOGLE_TRANSLATE_ON = settings.ENABLE_GOOGLE_TRANSLATE # initialize to value in settings
+    Fields that another thread or process is already fetching are left to it (see
+    autolex.flight); they are not counted as failed.
 
-def check_google_translate_errors():
+    ** Output parameters **
+    A list of the (object, field) pairs that could not be translated.
     """
-    Checks how many errors have been requested by recent requests to Google Translate.
-    Disables communication with Google if the number of errors reaches any of the following thresholds:
-         - 10 or more errors within 5 minutes
-         - 20 or more errors within 1 hour
-         - 50 or more errors within 1 day
+    jobs = []
+    for object, fields in missing:
+        translation_set = uuid.uuid4()
+        for field in fields:
+            jobs.append((object, field, translation_set))
+
+    # If we have disabled Google Translate, return without doing anything.
+    if not jobs or not google_translate_on():
+        return [(object, field) for object, field, translation_set in jobs]
+
+    # Only fetch the fields that nobody else is fetching (see autolex.flight).
+    flight = Flight([cache_key(object, field, to_language) for object, field, translation_set in jobs])
+    try:
+        # Fetch each claimed field once, even if it was asked for twice.
+        claimed = set(flight.claimed)
+        claimed_jobs = []
+        for object, field, translation_set in jobs:
+            key = cache_key(object, field, to_language)
+            if key in claimed:
+                claimed.remove(key)
+                claimed_jobs.append((object, field, translation_set))
+        jobs = claimed_jobs
+        failed = []
+        writer = TranslationWriter()
+        all_translated_chunks = translate_chunks([(object, get_chunks_to_translate(object, field))
+                                                  for object, field, translation_set in jobs],
+                                                 to_language, ip_address)
+        for (object, field, translation_set), translated_chunks in zip(jobs, all_translated_chunks):
+            if translated_chunks is not None:
+                writer.add(object, field, to_language, join_translated_chunks(translated_chunks), translation_set)
+            else:
+                failed.append((object, field))
+
+        # Save all of the new translations at once.
+        writer.flush()
+    finally:
+        flight.release()
+
+    # Give the other threads fetching fields we wanted a chance to save them.
+    flight.wait()
+    return failed
+
+
+def get_missing_fields(keyed_objects, existing_translations, to_language):
     """
+    Determines which fields of which objects still need a translation.
 
-    global GOOGLE_TRANSLATE_ERRORS
-    global GOOGLE_TRANSLATE_ON
-    if len(GOOGLE_TRANSLATE_ERRORS) >= 5 and GOOGLE_TRANSLATE_ERRORS[-1]['time'] - GOOGLE_TRANSLATE_ERRORS[-5]['time'] < timedelta(minutes=5):
-        # If at least 5 errors have been generated in the last 5 minutes, turn translations off.
-        # TO DO send an error message containing the contents of the registry
-        GOOGLE_TRANSLATE_ON = False
-        return
+    ** Input parameters **
+    keyed_objects: a list of the form [ (object, (content_type_id, object_id)) ]
+    existing_translations: a set of the (content_type_id, object_id, field) keys of existing translations
 
-    if len(GOOGLE_TRANSLATE_ERRORS) >= 20 and GOOGLE_TRANSLATE_ERRORS[-1]['time'] - GOOGLE_TRANSLATE_ERRORS[-20]['time'] < timedelta(hours=1):
-        # If at least 20 errors have been generated in the last hour, turn translations off.
-        GOOGLE_TRANSLATE_ON = False
-        return
+    ** Output parameters **
+    A list of the form [ (object, ['field1', 'field2']) ] containing only objects
+    that are missing at least one translation. Empty fields and objects already
+    written in to_language are skipped.
+    """
+    missing = []
+    for object, (content_type_id, object_id) in keyed_objects:
+        if object.language == to_language:
+            continue
+        fields = [field for field in object.translated_fields
+                  if (content_type_id, object_id, field) not in existing_translations
+                  # do not get a translation if this field is empty
+                  and object.__getattribute__(field) != '']
+        if fields:
+            missing.append((object, fields))
+    return missing
+
+
+# Stops communication with Google while it keeps rejecting our requests, and probes it
+# again later (see autolex.breaker). Shared by the worker threads.
+GOOGLE_TRANSLATE_BREAKER = get_google_translate_breaker()
+
+def google_translate_on():
+    """
+    Returns False if Google Translate is turned off in settings.py, or if the circuit
+    breaker is open because Google has been rejecting our requests.
+    """
+    return GOOGLE_TRANSLATE_BREAKER.is_available()
 
-    if len(GOOGLE_TRANSLATE_ERRORS) >= 50 and GOOGLE_TRANSLATE_ERRORS[-1]['time'] - GOOGLE_TRANSLATE_ERRORS[-50]['time'] < timedelta(days=1):
-        # If at least 50 errors have been generated in the last day, turn translations off.
-        GOOGLE_TRANSLATE_ON = False
-        return
+def record_google_translate_error(error):
+    """
+    Records a failed request to Google. Disables communication with Google for a while
+    if there have been too many failures recently (see autolex.breaker.THRESHOLDS).
+    """
+    GOOGLE_TRANSLATE_BREAKER.record_failure(error)
 
 
 def communicate_with_google(object, text, to_language, ip_address):
-        # Construct the appropriate URL for querying the Google Translate API
-        # The URL includes the text to translate [urllib.quote(c)], the object's
-        # original language [object.language], the desired translation
-        # language [to_language], our API key [settings.GOOGLE_API_KEY],
-        # and the user's IP address [ip_address].
-        url = 'https://www.googleapis.com/language/translate/v2'
-        params = urllib.urlencode({'key' : settings.GOOGLE_API_KEY, \
-                                       'q': text, \
-                                       'target': to_language, \
-                                       'userip' : ip_address, \
-                                       'prettyprint' : 'true' \
-                                       })
-        headers = { 'Referer': settings.ROOT_URL , 'X-HTTP-Method-Override': 'GET' }
-        # Create a request from the URL, with a header noting this site as the referer
-        request = urllib2.Request(url, params, headers)
+    """ Sends a single string to Google for translation and returns the translated string. """
+    return communicate_with_google_batch([object], [text], to_language, ip_address)[0]
+
+
+def communicate_with_google_batch(objects, texts, to_language, ip_address):
+        """
+        Sends several strings to the translation backend (Google Translate, unless
+        settings.TRANSLATION_BACKEND says otherwise) in a single request and returns
+        the translated strings, in the same order. objects lists the object each string
+        came from, for logging.
+        """
+        object_names = ''
 
         # Ask Google for a response
         try:
-            response = urllib2.urlopen(request)
+            object_names = ", ".join(sorted(set([object.__unicode__() for object in objects])))
+            translated_texts = get_translation_backend().translate(texts, to_language, ip_address)
+            GOOGLE_TRANSLATE_BREAKER.record_success()
+            return translated_texts
         except urllib2.URLError, e:
-            global GOOGLE_TRANSLATE_ERRORS
             # If there is an error code, Google is rejecting the request.
             # Typical error is 400 ("bad request")
             if hasattr(e, 'code'):
 
-                GOOGLE_TRANSLATE_ERRORS.append({'error' : e.code, 'time' : datetime.now()})
+                record_google_translate_error(e.code)
                 log.error("HTTP %s: Fetching %s Google translation of object '%s' failed." \
-                              % (e.code, to_language, object.__unicode__()))
+                              % (e.code, to_language, object_names))
                 raise urllib2.URLError(e.code)
 
             # If there is some other URLError, log and notify.
             elif hasattr(e, 'reason'):
-                GOOGLE_TRANSLATE_ERRORS.append({'error' : e.reason, 'time' : datetime.now()})
+                record_google_translate_error(e.reason)
                 log.error("HTTP %s: Fetching %s Google translation of object '%s' failed." \
-                              % (e.reason, to_language, object.__unicode__()))
+                              % (e.reason, to_language, object_names))
                 raise urllib2.URLError(e.reason)
 
-        except:
+        except Exception, e:
             # A general error
-            GOOGLE_TRANSLATE_ERRORS.append({'error' : e, 'time' : datetime.now()})
+            record_google_translate_error(e)
             log.error("URLError: Fetching %s Google translation of object '%s' failed." \
-                          % (to_language, object.__unicode__()))
+                          % (to_language, object_names))
             raise Exception
 
-        # If a successful response was obtained...
-        else:
-            # Process the JSON string.
-            results = simplejson.load(response)
-            return results['data']['translations'][0]['translatedText']
 
-
-def break_into_chunks(string,chunks=[],length_of_chunk=5000):
-    if len(string) <= length_of_chunk:
-        chunks.append(string)
-        return chunks
-    if len(string) > length_of_chunk:
-        try:
-            # try to split on a period
-            char_to_split_on=string[:length_of_chunk].rindex(".")+1
-        except ValueError:
-            # no periods
-            char_to_split_on=length_of_chunk
-        chunks.append(string[:char_to_split_on])
-        string=string[char_to_split_on:]
-        return break_into_chunks(string,chunks,length_of_chunk)
-
-def fetch_google_translation(object, field_name, to_language, ip_address, translation_set=None):
+def pack_segments(segments, max_characters=None, max_segments=None):
     """
-    Gets a new Google translation of a text string according the following algorithm.
+    Groups strings into batches that can each be sent to Google in a single request.
 
-    0. Make sure use of the Google Translate API is activated.  If not, stop and return None.
-
-    1. Split the string into chunks to send to Google, and store those untranslated chunks in a list.
-    Google will only accept HTTP requests less than 5,000 characters long, as per their Terms of Service.
-    Here, we split each string into 2,500-character chunks so that
-    (length of the text) + (length of the rest of the request) stay under that limit.
-
-    2. Create a list, translation_list, for storing the translated chunks.
-
-    3. Send each chunk to Google for translation.
-    If Google comes back with a successful translation, add that translated chunk to translation_list
-    If the Google request times out or is unsuccessful, return None
-
-    4. Join the chunks in translation_list into one long string, translated_text.
+    ** Input Parameters **
+    segments: a list of strings
+    max_characters: the maximum url-encoded length of the strings in one batch
+    max_segments: the maximum number of strings in one batch
+    Both limits default to the translation backend's.
 
-    5. If we already have a Translation object (i.e. we are updating an expired Google translation), overwrite
-    its 'translation' field with the new translation.and save it.
+    ** Output Parameters **
+    A list of batches of the form [ [0, 1, 2], [3], [4, 5] ], where the numbers are
+    indexes into segments. Strings are kept in order; a string that is too long to
+    share a request is put in a batch on its own.
+    """
+    if max_characters is None:
+        max_characters = get_translation_backend().max_characters
+    if max_segments is None:
+        max_segments = get_translation_backend().max_segments
+
+    batches = []
+    batch = []
+    batch_length = 0
+    for index, segment in enumerate(segments):
+        # The length of "&q=" plus the url-encoded string
+        length = len(urllib.quote_plus(segment)) + 3
+        if batch and (batch_length + length > max_characters or len(batch) >= max_segments):
+            batches.append(batch)
+            batch = []
+            batch_length = 0
+        batch.append(index)
+        batch_length += length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# Characters that urllib.quote_plus leaves as they are; a space becomes a single "+".
+URL_SAFE_CHARACTERS = frozenset(string.ascii_letters + string.digits + '_.-' + ' ')
+SENTENCE_ENDINGS = frozenset('.!?')
+WHITESPACE = frozenset(string.whitespace)
+
+def url_encoded_length(character):
+    """ Returns the length of a character once url-encoded (see pack_segments). """
+    if character in URL_SAFE_CHARACTERS:
+        return 1
+    if isinstance(character, unicode):
+        return 3 * len(character.encode('utf-8'))
+    return 3
+
+def iter_chunks(text, max_length=5000):
+    """
+    Breaks a string into chunks whose url-encoded length is at most max_length,
+    yielding the chunks in order. Joined together, the chunks give back the string.
 
-    6. If we do not have a Translation object (i.e. this is the first time this item has been translated
-    into this language), create a new one and save it.
+    ** Algorithm **
 
-    7. Return the translation.
+    Scan forward from the start of the chunk, adding up the url-encoded length of
+    each character and remembering the last place the chunk could end:
+    - after a sentence (a '.', '!' or '?' followed by whitespace),
+    - after a line break ('<br>', as get_chunks_to_translate writes them, or a newline),
+    - after whitespace.
+    When the next character would make the chunk too long, end the chunk at the
+    first of these, in that order, that keeps at least half of the chunk; failing
+    that, at the last of them if it keeps at least a tenth, so that a boundary near
+    the start does not cost a request for a tiny chunk; failing that (a very long
+    word), right there, though never in the middle of a UTF-8 character.
+
+    Each character is scanned at most twice, so the running time is linear in the
+    length of the string, and the rest of the string is never copied.
     """
+    length = len(text)
+    if not length:
+        yield text
+        return
 
+    start = 0
+    while start < length:
+        cost = 0
+        boundaries = {} # kind : (offset, cost of the chunk up to the offset)
+        i = start
+        while i < length:
+            character = text[i]
+            if character in URL_SAFE_CHARACTERS:
+                cost += 1
+            else:
+                cost += url_encoded_length(character)
+            if cost > max_length:
+                break
+            i += 1
+            if character in WHITESPACE:
+                boundaries['space'] = (i, cost)
+                if character == '\n':
+                    boundaries['newline'] = (i, cost)
+                if i - 2 >= start and text[i - 2] in SENTENCE_ENDINGS:
+                    boundaries['sentence'] = (i, cost)
+            elif character == '>' and i - 4 >= start and text[i - 4:i] == '<br>':
+                boundaries['newline'] = (i, cost)
+        else:
+            # The rest of the string fits.
+            yield text[start:]
+            return
 
-    # If we have disabled Google Translate (for example, because Google started rejecting our requests,
-    # or because it is turned off in settings.py) return without doing anything.
-    global GOOGLE_TRANSLATE_ON
-    if not GOOGLE_TRANSLATE_ON:
-        return
+        split = None
+        for kind in ('sentence', 'newline', 'space'):
+            if kind in boundaries and boundaries[kind][1] * 2 >= max_length:
+                split = boundaries[kind][0]
+                break
+        if split is None and boundaries:
+            offset, boundary_cost = max(boundaries.values())
+            if boundary_cost * 10 >= max_length:
+                split = offset
+        if split is None:
+            split = max(i, start + 1)
+            if isinstance(text, str):
+                # Do not split a UTF-8 encoded character (continuation bytes are 10xxxxxx).
+                while split - 1 > start and split < length and ord(text[split]) & 0xC0 == 0x80:
+                    split -= 1
+        yield text[start:split]
+        start = split
+
+def break_into_chunks(string, chunks=None, length_of_chunk=5000):
+    """
+    Returns a list of the chunks of string (see iter_chunks), appended to chunks if given.
+    """
+    if chunks is None:
+        chunks = []
+    chunks.extend(iter_chunks(string, length_of_chunk))
+    return chunks
 
+def get_chunks_to_translate(object, field_name):
+    """
+    Returns the text of an object's field as a list of chunks that are short enough to send to Google.
+    """
     # Get the appropriate text and encode it properly - Google will not accept unicode.
     text_to_translate = object.__getattribute__(field_name).encode('utf-8').replace("\n","<br>")
 
     # Break each string into a chunk short enough to comply with Google's character limit.
-    # Returns a list of the form [ "first chunk", "second chunk", "etc." ]. Breaks approximately
-    # every 5000 characters (Google's max query length for POST requests) and always on a period if possible.
-    chunks=[]
+    # Returns a list of the form [ "first chunk", "second chunk", "etc." ]. Each chunk, url-encoded
+    # and with its "&q=", fits in a single request, and breaks at the end of a sentence if possible.
+    return break_into_chunks(text_to_translate, length_of_chunk=get_translation_backend().max_characters - 3)
 
-    # Break the text into chunks
-    all_chunks=break_into_chunks(text_to_translate)
 
-    # Create a list for storing the translated chunks
-    translated_chunks = []
-    # Send each chunk to Google for translation
-    for c in all_chunks:
-        try:
-            translated_chunks.append(communicate_with_google(object, c, to_language, ip_address))
-        except:
-            return
+def translate_chunks(jobs, to_language, ip_address, concurrency=None):
+    """
+    Sends the chunks of several texts to Google.
 
-    # All chunks were translated successfully!
-    # Join them back together into a string
-    translated_text = ''.join(translated_chunks)
-    translated_text=translated_text.replace('<br>','***fakelinebreak***')
+    ** Input Parameters **
+    jobs: a list of the form [ (object, ["first chunk", "second chunk"]) ]
 
-    # Unescape HTML characters [i.e. convert &quot; to "]
-    # Snippet from http://wiki.python.org/moin/EscapingHtml
+    ** Output Parameters **
+    A list with one entry per job, in the same order as jobs: the list of translated
+    chunks (in the same order as the original chunks), or None if any of the job's
+    chunks could not be translated.
+
+    Chunks already in the translation memory are not sent again. The others, from all
+    of the jobs, are packed into as few requests as Google's limits
+    allow (see pack_segments), and at most `concurrency` requests (by default
+    settings.GOOGLE_TRANSLATE_CONCURRENCY) are sent at once. Errors are recorded by the circuit breaker as
+    they happen, so once it opens no further requests are sent and the remaining jobs fail.
+    """
+    tasks = []
+    for job_index, (object, chunks) in enumerate(jobs):
+        for chunk in chunks:
+            tasks.append((job_index, object, chunk))
+    translated_chunks = [None] * len(tasks)
+
+    # Look the chunks up in the translation memory (see autolex.memory), and only send
+    # Google one copy of each chunk that is not there.
+    keys = [memory_key(chunk, object.language, to_language) for job_index, object, chunk in tasks]
+    remembered = memory_enabled() and recall_translations(keys) or {}
+    to_send = {} # key : index in tasks of the chunk that will be sent to Google
+    for task_index, key in enumerate(keys):
+        if key in remembered:
+            translated_chunks[task_index] = remembered[key]
+        else:
+            to_send.setdefault(key, task_index)
+    send_indexes = sorted(to_send.values())
 
-    def unescape(s):
-        p = htmllib.HTMLParser(None)
-        p.save_bgn()
-        p.feed(s)
-        return p.save_end()
+    def translate_batch(batch):
+        # If the breaker is open, or another batch is already probing Google, skip the batch.
+        if not GOOGLE_TRANSLATE_BREAKER.allow_request():
+            return [None] * len(batch)
+        try:
+            return communicate_with_google_batch([tasks[i][1] for i in batch], [tasks[i][2] for i in batch],
+                                                 to_language, ip_address)
+        except Exception:
+            return [None] * len(batch)
+        finally:
+            GOOGLE_TRANSLATE_BREAKER.finish_request()
+
+    # Split each batch's translations back into the slots of the chunks they came from.
+    batches = [[send_indexes[i] for i in batch] for batch in
+               pack_segments([tasks[task_index][2] for task_index in send_indexes])]
+    for batch, translated_batch in zip(batches, map_in_pool(translate_batch, batches, concurrency)):
+        for task_index, translated_chunk in zip(batch, translated_batch):
+            translated_chunks[task_index] = translated_chunk
+
+    # Fill in the copies of the chunks that were sent, and remember the new translations.
+    new_translations = []
+    for task_index, key in enumerate(keys):
+        if key in to_send:
+            translated_chunks[task_index] = translated_chunks[to_send[key]]
+            if task_index == to_send[key] and translated_chunks[task_index] is not None:
+                new_translations.append((key, tasks[task_index][1].language, to_language,
+                                         translated_chunks[task_index]))
+    if memory_enabled():
+        remember_translations(new_translations)
+
+    results = [[] for job in jobs]
+    for (job_index, object, chunk), translated_chunk in zip(tasks, translated_chunks):
+        if results[job_index] is None:
+            continue
+        if translated_chunk is None:
+            # One failed chunk fails the whole text.
+            results[job_index] = None
+        else:
+            results[job_index].append(translated_chunk)
+    return results
+
+
+# Everything join_translated_chunks rewrites, matched in a single pass over the text:
+# line breaks, other tags (which are dropped), character references and whitespace other than
+# single spaces.
+HTML_TOKEN = re.compile(r'(?P<br><br\s*/?>)'
+                        r'|(?P<tag></?[a-zA-Z!][^>]*>)'
+                        r'|&(?:#(?P<decimal>[0-9]+)|#[xX](?P<hex>[0-9a-fA-F]+)|(?P<name>[a-zA-Z][a-zA-Z0-9]*));'
+                        r'|(?P<space>\s\s+|[^\S ])', re.UNICODE | re.IGNORECASE)
+
+def unescape_html_token(match):
+    """ Returns the replacement for a match of HTML_TOKEN. """
+    if match.group('space') is not None:
+        return u' '
+    if match.group('br') is not None:
+        return u'\n'
+    if match.group('tag') is not None:
+        return u''
+    try:
+        if match.group('decimal') is not None:
+            return unichr(int(match.group('decimal')))
+        if match.group('hex') is not None:
+            return unichr(int(match.group('hex'), 16))
+    except (ValueError, OverflowError):
+        # Not a character this Python can represent: leave the reference alone.
+        return match.group(0)
+    codepoint = htmlentitydefs.name2codepoint.get(match.group('name'))
+    if codepoint is None:
+        return match.group(0)
+    return unichr(codepoint)
+
+def join_translated_chunks(translated_chunks):
+    """
+    Joins translated chunks back together into a string, restoring line breaks and
+    unescaping the HTML characters in Google's response [i.e. converting &quot; to "].
 
-    translated_text=unescape(translated_text)
-    translated_text=translated_text.replace("***fakelinebreak***","\n")
+    As Google's response used to be read with htmllib, other tags are dropped and runs
+    of whitespace are collapsed into single spaces.
+    """
+    translated_text = u''.join([smart_unicode(chunk) for chunk in translated_chunks])
+    return HTML_TOKEN.sub(unescape_html_token, translated_text).strip(u' ')
 
 
-    # Create a new translation object.
+def save_google_translation(object, field_name, to_language, translated_text, translation_set=None):
+    """ Creates a new Translation object from a Google translation. """
     if settings.COMMON_IDENTIFIER:
         id = object.__getattribute__(settings.COMMON_IDENTIFIER)
     else:
         id = object.id
     content_type = ContentType.objects.get_for_model(object)
     t = Translation.active.create(content_type=content_type, object_id=id,
-                                   field=field_name, language=to_language, from_google=True,
-                                   translation=translated_text, translation_set=translation_set)
-    t.save()
-    return
+                                  field=field_name, language=to_language, from_google=True,
+                                  translation=translated_text, translation_set=translation_set,
+                                  source_hash=source_hash(object.__getattribute__(field_name)))
+    forget_translations(object)
+    return t
+
+
+def fetch_google_translation(object, field_name, to_language, ip_address, translation_set=None):
+    """
+    Gets a new Google translation of a text string according the following algorithm.
+
+    0. Make sure use of the Google Translate API is activated.  If not, stop and return None.
+
+    1. Split the string into chunks to send to Google, and store those untranslated chunks in a list.
+    Google will only accept HTTP requests less than 5,000 characters long, as per their Terms of Service.
+    Here, we split each string into 2,500-character chunks so that
+    (length of the text) + (length of the rest of the request) stay under that limit.
+
+    2. Send the chunks to Google for translation, several at a time (see translate_chunks).
+    If the Google request times out or is unsuccessful for any chunk, return None
+
+    3. Join the translated chunks, in their original order, into one long string, translated_text.
+
+    4. Create a new Translation object and save it.
+
+    5. Return the translation.
+    """
+
+
+    # If we have disabled Google Translate (for example, because Google started rejecting our requests,
+    # or because it is turned off in settings.py) return without doing anything.
+    if not google_translate_on():
+        return
+
+    # Break the text into chunks and send them to Google.
+    translated_chunks = translate_chunks([(object, get_chunks_to_translate(object, field_name))],
+                                         to_language, ip_address)[0]
+    if translated_chunks is None:
+        return
+
+    # All chunks were translated successfully!
+    # Join them back together into a string and create a new translation object.
+    return save_google_translation(object, field_name, to_language, join_translated_chunks(translated_chunks),
+                                   translation_set)
 
 
 def get_translated_version(object, field_name, to_language=None):
@@ -377,27 +652,219 @@ def get_translated_version(object, field_name, to_language=None):
 
     if to_language == object.language:
         return object.__getattribute__(field_name)
+
     try:
-        # Look for a translation in the database.
-        # If one is found, return it.
-        if settings.COMMON_IDENTIFIER:
-            id = object.__getattribute__(settings.COMMON_IDENTIFIER)
-            t = Translation.active.get(object_id=id, field=field_name, language=to_language)
-        else:
-            content_type = ContentType.objects.get_for_model(object)
-            t = Translation.active.get(object_id=object.id, content_type=content_type,
-                                        field=field_name,language=to_language)
-        return t.translation
-    except (Translation.DoesNotExist, AttributeError):
+        key = cache_key(object, field_name, to_language)
+    except AttributeError:
+        # The object does not have a common identifier; fall back on the original text.
+        return object.__getattribute__(field_name)
+
+    # Look for the translation in the cache first.
+    cached = get_cached_translations([key]).get(key)
+    if cached is MISSING:
+        return object.__getattribute__(field_name)
+    elif cached is not None:
+        return cached
+
+    # Look for a translation in the database.
+    if settings.COMMON_IDENTIFIER:
+        translations = Translation.active.filter(object_id=key[1], field=field_name, language=to_language)
+    else:
+        translations = Translation.active.filter(object_id=key[1], content_type=key[0],
+                                                 field=field_name, language=to_language)
+    try:
+        t = translations.get()
+    except Translation.DoesNotExist:
         # If there is no translation, fall back on the original text.
+        cache_translations({key : MISSING})
         return object.__getattribute__(field_name)
     except MultipleObjectsReturned:
         # If there is more than one translation, log an error (there should only be one active translation).
         # Get the most recent translation
         log.error("Error: Multiple translations returned for the %s field object '%s' in language %s" \
                       % (field_name, object.__unicode__(), to_language,))
-        return Translation.active.filter(object_id=object.id, content_type=content_type,
-                                        field=field_name,language=to_language).order_by("-last_modified_at")[0].translation
+        t = translations.order_by("-last_modified_at")[0]
+
+    # If one is found, return it.
+    cache_translations({key : t.translation})
+    return t.translation
+
+
+def cache_key(object, field_name, to_language):
+    """
+    Returns the (content_type_id, object_id, field, language) key of a translation in
+    the process-local cache. content_type_id is None when using a common identifier.
+    """
+    if settings.COMMON_IDENTIFIER:
+        return (None, object.__getattribute__(settings.COMMON_IDENTIFIER), field_name, to_language)
+    return (ContentType.objects.get_for_model(object).id, object.id, field_name, to_language)
+
+
+def cache_key_for_translation_key(key, to_language):
+    """ Converts a key from get_translated_versions (see translation_key) into a cache key. """
+    content_type, object_id, field_name = key
+    if settings.COMMON_IDENTIFIER:
+        return (None, object_id, field_name, to_language)
+    return (content_type.id, object_id, field_name, to_language)
+
+
+def translation_key(object, field_name):
+    """
+    Returns the (content_type, object_id, field) key used to look up an object's
+    translation in the dictionary built by get_translated_versions.
+    """
+    if settings.COMMON_IDENTIFIER:
+        id = object.__getattribute__(settings.COMMON_IDENTIFIER)
+    else:
+        id = object.id
+    return (ContentType.objects.get_for_model(object), id, field_name)
+
+
+def get_translated_versions(object_list, fields=None, to_language=None):
+    """
+    Bulk version of get_translated_version. Used with feeds to avoid querying the
+    database once for every field of every object.
+
+    ** Input Parameters **
+    object_list: a list of objects containing translated fields
+    fields: the fields whose translations we want. Defaults to each object's translated_fields.
+
+    ** Modifications **
+    None
+
+    ** Output Parameters **
+    A dictionary of the form { (content_type, object_id, field) : text } with an entry
+    for each requested field of each object (see translation_key). Falls back to the
+    original text for any field without a translation.
+
+    ** Algorithm **
+
+    0. Get the desired language for display.
+
+    1. Fill the dictionary with the original text of every requested field.
+
+    2. Query the database for the translations of every object whose language does not
+       match the desired language - once per content type, or once in total if we are
+       using a common identifier.
+
+    3. Overwrite the original text with the translations that were found. If there is
+       more than one active translation for a field, the most recent one wins.
+
+    """
+
+    if not to_language:
+        to_language = translation.get_language()
+
+    versions = {}
+
+    # The keys of the fields that need a translation
+    needed = []
+    for object in object_list:
+        if fields is None:
+            object_fields = object.translated_fields
+        else:
+            object_fields = fields
+        for field_name in object_fields:
+            if field_name not in object.translated_fields:
+                raise ValueError("This field is not marked for translation")
+            key = translation_key(object, field_name)
+            versions[key] = object.__getattribute__(field_name)
+            if object.language != to_language:
+                needed.append(key)
+
+    # Look in the caches first.
+    cache_keys = dict([(key, cache_key_for_translation_key(key, to_language)) for key in needed])
+    cached = get_cached_translations(cache_keys.values())
+
+    # items will look like { <Content Type 1> : set([1, 2, 3]), <Content Type 2> : set([4, 5, 6]) }
+    # where the numbers are the ids of the objects that need a translation which is not cached.
+    items = {}
+    # The keys of the fields we are looking for in the database
+    queried = set()
+    for key in needed:
+        value = cached.get(cache_keys[key])
+        if value is None:
+            queried.add(key)
+            items.setdefault(key[0], set()).add(key[1])
+        elif value is not MISSING:
+            versions[key] = value
+
+    if not items:
+        return versions
+
+    if settings.COMMON_IDENTIFIER:
+        # Translations are shared between content types through the common identifier,
+        # so a single query covers every object.
+        ids_list = set()
+        for ids in items.values():
+            ids_list.update(ids)
+        queries = [(None, Translation.active.filter(object_id__in=ids_list, language=to_language))]
+    else:
+        queries = [(content_type, Translation.active.filter(object_id__in=ids, content_type=content_type,
+                                                            language=to_language))
+                   for content_type, ids in items.items()]
+
+    found = set()
+    for content_type, query in queries:
+        # Oldest first, so that the most recent translation of a field is the one left in the dictionary.
+        for t in query.order_by("last_modified_at"):
+            if content_type is None:
+                keys = [(ct, t.object_id, t.field) for ct in items.keys() if t.object_id in items[ct]]
+            else:
+                keys = [(content_type, t.object_id, t.field)]
+            for key in keys:
+                if key not in versions:
+                    # A translation of a field we were not asked for.
+                    continue
+                if key in found:
+                    # If there is more than one translation, log an error (there should only be one active translation).
+                    log.error("Error: Multiple translations returned for the %s field of object %s in language %s" \
+                                  % (t.field, t.object_id, to_language))
+                found.add(key)
+                versions[key] = t.translation
+
+    values = {}
+    for key in queried:
+        if key in found:
+            values[cache_keys[key]] = versions[key]
+        else:
+            values[cache_keys[key]] = MISSING
+    cache_translations(values)
+
+    return versions
+
+
+def prefetch_translations(object_list, to_language=None, fields=None):
+    """
+    Looks up the translated versions of many objects' fields at once (see
+    get_translated_versions) and attaches them to the objects, so that
+    object.translated(field) returns them without querying the database.
+    Used by TranslatedQuerySet.with_translations and the prefetch_translations template tag.
+
+    ** Input Parameters **
+    object_list: a list of TranslatedItems
+    fields: the fields whose translations we want. Defaults to each object's translated_fields.
+
+    ** Output Parameters **
+    The objects, as a list.
+    """
+    if not to_language:
+        to_language = translation.get_language()
+    object_list = list(object_list)
+    if not object_list:
+        return object_list
+
+    versions = get_translated_versions(object_list, fields, to_language)
+    for object in object_list:
+        if fields is None:
+            object_fields = object.translated_fields
+        else:
+            object_fields = fields
+        prefetched = object.__dict__.setdefault('_translated_versions', {})
+        for field_name in object_fields:
+            prefetched[(field_name, to_language)] = versions[translation_key(object, field_name)]
+    return object_list
+
 
 def translation_from_google(object):
     """ Returns True if an object's desired translation is from Google, False if it is not."""
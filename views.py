@@ -1,4 +1,6 @@
 from translate.models import Translation
+from translate.utils import make_translations
+from translate.tasks import enqueue_translations
 from community.models import Language, Node
 
 #########################
@@ -17,7 +19,11 @@ def get_node_with_privileges(user, node_name,community):
     leaf = node.as_leaf_node()
     #if leaf.get_community_id() == community.id:
     userprofile = user.get_profile()
-    Translation.update_all_translations(leaf, userprofile.ip)
+    if getattr(settings, 'TRANSLATE_IN_BACKGROUND', False):
+        # Leave the missing translations to a background worker (see autolex.tasks)
+        enqueue_translations([leaf], userprofile.ip)
+    else:
+        make_translations([leaf], userprofile.ip)
     return node
 
 def translator(user):
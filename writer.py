@@ -0,0 +1,168 @@
+"""
+Batched writes of new Google translations.
+
+Use as follows:
+writer = TranslationWriter()
+for object, field, text, translation_set in new_translations:
+    writer.add(object, field, 'es', text, translation_set)
+saved = writer.flush()
+
+flush() writes every pending translation in one transaction, with a single
+bulk_create, instead of the create-then-save of save_google_translation.
+
+Another process may translate the same fields at the same time, and nothing in
+the table stops two active translations of one field. flush() skips fields that
+already have an active translation when it writes, and after committing it
+deactivates the Google translations of those fields that readers would not pick
+anyway (see remove_duplicates), so concurrent writers agree on which translation
+is kept. Translations made by people are never touched.
+"""
+
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.contrib.contenttypes.models import ContentType
+
+from autolex.models import Translation, forget_translations
+from autolex.cache import invalidate_translation
+from autolex.retranslate import source_hash
+
+
+class TranslationWriter(object):
+
+    def __init__(self):
+        self.pending = [] # unsaved Translation objects
+        self.objects = [] # the objects they translate
+        self.content_type_ids = {} # model class : content type id
+
+    def lookup_key(self, translation):
+        """
+        Returns the (content_type_id, object_id, field, language) key under which
+        translations are looked up; content_type_id is None when translations are
+        shared through settings.COMMON_IDENTIFIER.
+        """
+        if settings.COMMON_IDENTIFIER:
+            return (None, translation.object_id, translation.field, translation.language)
+        return (translation.content_type_id, translation.object_id, translation.field, translation.language)
+
+    def add(self, object, field_name, to_language, translated_text, translation_set=None):
+        """ Queues a new Google translation of object's field_name for the next flush. """
+        if settings.COMMON_IDENTIFIER:
+            id = object.__getattribute__(settings.COMMON_IDENTIFIER)
+        else:
+            id = object.id
+        if object.__class__ not in self.content_type_ids:
+            self.content_type_ids[object.__class__] = ContentType.objects.get_for_model(object).id
+        if translation_set is not None:
+            translation_set = str(translation_set)
+        self.objects.append(object)
+        self.pending.append(Translation(content_type_id=self.content_type_ids[object.__class__], object_id=id,
+                                        field=field_name, language=to_language, from_google=True,
+                                        translation=translated_text, translation_set=translation_set,
+                                        source_hash=source_hash(object.__getattribute__(field_name))))
+
+    def signature(self, translation):
+        """
+        Returns what tells a translation this writer wrote apart from other translations
+        of its field; bulk_create does not always set ids.
+        """
+        return self.lookup_key(translation) + (translation.translation_set, translation.translation)
+
+    def existing_keys(self, translations):
+        """ Returns the lookup keys of the given translations that already have an active translation. """
+        # Query once per (content type, language), or once per language when using a common identifier.
+        groups = {}
+        for t in translations:
+            key = self.lookup_key(t)
+            groups.setdefault((key[0], key[3]), set()).add(t.object_id)
+
+        existing = set()
+        for (content_type_id, language), ids in groups.items():
+            rows = Translation.active.filter(object_id__in=ids, language=language)
+            if content_type_id is not None:
+                rows = rows.filter(content_type=content_type_id)
+            for object_id, field in rows.values_list('object_id', 'field'):
+                existing.add((content_type_id, object_id, field, language))
+        return existing
+
+    @transaction.commit_on_success
+    def insert(self, translations):
+        """ Inserts the translations that nobody else has written yet, in one transaction. """
+        existing = self.existing_keys(translations)
+        new = []
+        for t in translations:
+            key = self.lookup_key(t)
+            if key not in existing:
+                existing.add(key)
+                new.append(t)
+
+        # bulk_create does not call Translation.save, so set the timestamps here.
+        now = datetime.now()
+        for t in new:
+            t.created_at = now
+            t.last_modified_at = now
+
+        Translation.objects.bulk_create(new)
+        return new
+
+    def remove_duplicates(self, translations):
+        """
+        Deactivates the superseded Google translations of the fields in translations,
+        in case someone else wrote the same fields while we did:
+
+        - a translation made by a person (from_google=False) supersedes them all;
+        - otherwise the most recent Google translation is kept, as get_translation
+          would return it, with the highest id breaking ties.
+
+        Every writer removes duplicates after committing, so the last one to do so sees
+        every translation written and keeps the same one an earlier writer would have
+        kept from what it saw.
+        """
+        keys = set([self.lookup_key(t) for t in translations])
+        groups = {}
+        for key in keys:
+            groups.setdefault((key[0], key[3]), set()).add(key[1])
+
+        duplicates = []
+        for (content_type_id, language), ids in groups.items():
+            rows = Translation.active.filter(object_id__in=ids, language=language)
+            if content_type_id is not None:
+                rows = rows.filter(content_type=content_type_id)
+            rows_by_key = {}
+            for t in rows:
+                key = self.lookup_key(t)
+                if key in keys:
+                    rows_by_key.setdefault(key, []).append(t)
+
+            for key, candidates in rows_by_key.items():
+                if [t for t in candidates if not t.from_google]:
+                    kept = None
+                else:
+                    kept = max(candidates, key=lambda t: (t.last_modified_at, t.id))
+                duplicates += [t for t in candidates if t.from_google and t is not kept]
+
+        if duplicates:
+            Translation.objects.filter(id__in=[t.id for t in duplicates]).update(is_active=False)
+        return duplicates
+
+    def flush(self):
+        """
+        Writes the pending translations and returns the ones that were saved.
+        Queryset updates and bulk_create send no signals, so the translation cache
+        is invalidated here, along with the translations the objects remember.
+        """
+        translations, self.pending = self.pending, []
+        objects, self.objects = self.objects, []
+        if not translations:
+            return []
+
+        saved = self.insert(translations)
+        duplicates = self.remove_duplicates(saved)
+        for t in saved + duplicates:
+            invalidate_translation(Translation, t)
+        for object in objects:
+            forget_translations(object)
+
+        deactivated = set([self.signature(t) for t in duplicates])
+        return [t for t in saved if self.signature(t) not in deactivated]